@@ -6,28 +6,34 @@ import requests
 import scorched
 import datetime
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import django.core.exceptions as django_exceptions
 from django.conf import settings
-from django.template.defaultfilters import strip_tags
+from django.db import transaction, IntegrityError
 from django.utils import timezone
 
 from misirlou.models import Manifest
 from misirlou.signals import manifest_imported
 from misirlou.helpers.manifest_utils.errors import ErrorMap
-from misirlou.helpers.manifest_utils.utils import get_language
+from misirlou.helpers.manifest_utils.utils import get_language, get_basic_url, strip_html
+from misirlou.helpers.manifest_utils.scanner import scan_manifest
 from misirlou.helpers.requester import DEFAULT_REQUESTER
+from misirlou.helpers.solr import get_solr_interface
+from misirlou.helpers import search_cache
 
 indexed_langs = ["en", "fr", "it", "de"]
+# Top-level fields of a manifest used to build its solr document.
+indexed_fields = ["@id", "@type", "label", "description", "attribution", "metadata", "thumbnail", "logo"]
 timeout_error = "Timed out fetching '{}'"
 ERROR_MAP = ErrorMap()
 
 requester = DEFAULT_REQUESTER
 
 
-def get_doc(remote_url):
+def get_doc(remote_url, **kwargs):
     """Get a document using requests."""
-    return requester.get(remote_url, verify=False, timeout=20)
+    return requester.get(remote_url, verify=False, timeout=20, **kwargs)
 
 
 class ManifestImportError(Exception):
@@ -41,28 +47,36 @@ class ManifestPreImporter:
     Fetches the document and makes sure it has some basic properties.
 
     get_all_urls(self) will recurse into all nested collections and
-    compile a list of manifest urls to be imported.
+    compile a list of manifest urls to be imported. iter_urls(self) does
+    the same, but yields each url as soon as it is discovered.
     """
 
     def __init__(self, remote_url):
         self.remote_url = remote_url
         self.errors = []
         self.warnings = []
-        self.text = None
+        self.content = None
         self.json = {}
         self.type = ""
         self._prepare_for_creation()
 
+    @property
+    def text(self):
+        """The fetched document decoded to text (e.g., to pass it to a task)."""
+        if self.content is None:
+            return None
+        return self.content.decode('utf-8')
+
     def _prepare_for_creation(self):
         try:
             manifest_resp = get_doc(self.remote_url)
         except requests.exceptions.Timeout:
             self.errors.append(timeout_error.format(self.remote_url))
             return
-        self.text = manifest_resp.text
+        self.content = manifest_resp.content
 
         try:
-            self.json = json.loads(self.text)
+            self.json = json.loads(self.content)
         except ValueError:
             self.errors.append("Retrieved document is not valid JSON.")
             return
@@ -85,63 +99,121 @@ class ManifestPreImporter:
 
         :return: List of strings with importable URLs.
         """
+        return list(self.iter_urls())
+
+    def iter_urls(self):
+        """Yield the importable URLs related to the remote_url as they are found.
+
+        Linked collections are fetched concurrently by a bounded pool of
+        threads. Every fetch still goes through the requester, which reserves
+        a slot per domain, so the collections of one host are still fetched
+        one crawl-delay apart and discovery time grows with the number of
+        collections. The threads only overlap the network latency of each
+        fetch with those waits, and the fetches to different hosts.
+        """
         if len(self.errors):
-            return []
+            return
 
         if self.type == "sc:Manifest":
-            return [self.remote_url]
+            yield self.remote_url
+            return
 
-        elif self.type == "sc:Collection":
-            return self._get_nested_manifests(self.json)
+        if self.type != "sc:Collection":
+            return
 
-    def _get_nested_manifests(self, json_obj, manifest_set=None):
-        """Find and add nested manifest urls to manifest_set.
+        found = set()
+        fetched = {self.remote_url}
+        manifests, linked = self._scan_collection(self.json)
+        for url in manifests:
+            if url not in found:
+                found.add(url)
+                yield url
+
+        with ThreadPoolExecutor(max_workers=settings.IMPORT_CRAWL_WORKERS) as pool:
+            pending = {}
+            while True:
+                for col_url in linked:
+                    if col_url not in fetched:
+                        fetched.add(col_url)
+                        pending[pool.submit(get_doc, col_url)] = col_url
+                if not pending:
+                    break
+
+                linked = []
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    col_url = pending.pop(future)
+                    col_json = self._load_collection(future, col_url)
+                    if col_json is None:
+                        continue
+                    col_manifests, col_linked = self._scan_collection(col_json)
+                    linked.extend(col_linked)
+                    for url in col_manifests:
+                        if url not in found:
+                            found.add(url)
+                            yield url
+
+    def _load_collection(self, future, col_url):
+        """Return the parsed json of a fetched collection, or None on failure."""
+        try:
+            col_resp = future.result()
+        except requests.exceptions.Timeout:
+            self.errors.append("Timed out fetching nested collection at '{}'".format(col_url))
+            return None
+        except requests.exceptions.RequestException:
+            self.errors.append("Failed to fetch nested collection at '{}'".format(col_url))
+            return None
 
-        :param json_obj: A json decoded Manifest or Collection.
-        :param manifest_set: A set for collecting remote_urls.
-        :return: A list of urls of manifests.
+        try:
+            return json.loads(col_resp.content)
+        except ValueError:
+            self.errors.append("Nested collection at '{}' is not valid JSON.".format(col_url))
+            return None
+
+    def _scan_collection(self, json_obj, manifests=None, linked=None):
+        """Find manifest urls and linked collection urls in a collection.
+
+        Embedded collections are scanned in place. Linked collections (those
+        which must be fetched to be read) are only collected, so the caller
+        can fetch them concurrently.
+
+        :param json_obj: A json decoded Collection.
+        :return: A tuple of (manifest urls, linked collection urls).
         """
-        if manifest_set is None:
-            manifest_set = set()
+        if manifests is None:
+            manifests = []
+        if linked is None:
+            linked = []
+
+        def add_collection(col):
+            # Handle embedded collections.
+            if col.get('manifests') or col.get('members') or col.get('collections'):
+                self._scan_collection(col, manifests, linked)
+                return
+
+            # Handle linked collections.
+            col_url = col.get("@id")
+            if col_url:
+                linked.append(col_url)
 
         # Recurse into members key.
         members = json_obj.get('members', [])
         for member in members:
-            if member['@type'] == 'sc:Manifest':
-                manifest_set.add(member['@id'])
-            if member['@type'] == 'sc:Collection:':
-                self._get_nested_manifests(member, manifest_set)
+            if member.get('@type') == 'sc:Manifest':
+                manifests.append(member['@id'])
+            if member.get('@type') == 'sc:Collection':
+                add_collection(member)
 
         # Handle an embedded list of manifests.
-        manifests = json_obj.get('manifests', [])
-        for man in manifests:
+        for man in json_obj.get('manifests', []):
             tmp_url = man.get("@id")
-            if(tmp_url):
-                manifest_set.add(tmp_url)
-
-        collections = json_obj.get('collections', [])
-        for col in collections:
-            # Handle embedded collections.
-            manifests = col.get('manifests')
-            if manifests:
-                self._get_nested_manifests(col, manifest_set)
-                continue
-
-            # Handle linked collections.
-            col_url = col.get("@id")
-            if not col_url:
-                continue
-            try:
-                col_resp = get_doc(col_url)
-            except requests.exceptions.Timeout:
-                self.errors.append("Timed out fetching nested collection at '{}'".format(col_url))
-                continue
+            if tmp_url:
+                manifests.append(tmp_url)
 
-            col_data = col_resp.text
-            col_json = json.loads(col_data)
-            self._get_nested_manifests(col_json, manifest_set)
+        for col in json_obj.get('collections', []):
+            add_collection(col)
 
-        return list(manifest_set)
+        return manifests, linked
 
 
 class ManifestImporter:
@@ -165,34 +237,59 @@ class ManifestImporter:
         self.warnings = []
         self.db_rep = None
         self.manifest_hash = ""
+        self.etag = None
+        self.last_modified = None
+        self.not_modified = False
+        self.index_failed = False
+        self.trusted = False
+        # Cleared to leave bumping the search cache to the caller of a bulk reindex.
+        self.bump_search_cache = True
+        # The serialized manifest, as long as it matches self.json.
+        self.raw_json = None
         if prefetched_data:
             self.manifest_hash = self.generate_manifest_hash(prefetched_data)
             self.json = json.loads(prefetched_data)
+            self.raw_json = prefetched_data
         else:
             self.json = {}
 
-    def create(self, force=False):
+    def create(self, force=False, index_buffer=None):
         """ Go through the steps of validating and indexing this manifest.
 
+        If an index_buffer (a SolrIndexBuffer) is given, the solr document is
+        handed to it instead of being indexed right away. The import is then
+        finished (or marked as failed, setting self.index_failed) when the
+        buffer is flushed.
+
         Return False if error hit, True otherwise."""
         # Find existing db rep, or create one.
         in_db = self._find_existing_db_rep()
         if not in_db:
             man = Manifest(remote_url=self.remote_url, id=self.id,
                            manifest_hash=self.manifest_hash, indexed=False)
-            man.save()
-            self.db_rep = man
+            try:
+                with transaction.atomic():
+                    man.save()
+                self.db_rep = man
+            except IntegrityError:
+                # Another import of the same url created it first.
+                if not self._find_existing_db_rep():
+                    raise
 
         # Get the doc if we don't have it.
         try:
-            self._retrieve_json()
+            self._retrieve_json(conditional=not force, parse_unchanged=force)
         except ManifestImportError:
             return self._exit(ERROR_MAP['FAILED_REMOTE_RETRIEVAL'].code)
 
+        # If the remote says it hasn't changed, then do nothing.
+        if self.not_modified:
+            self.warnings.append("Manifest has not changed since last indexed. No work done.")
+            return True
+
         # If it's in db, is indexed, and hasn't changed, then do nothing.
-        if self.db_rep.manifest_hash == self.manifest_hash \
-                and self.db_rep.indexed\
-                and not force:
+        if self._is_unchanged() and not force:
+            self._save_remote_validators()
             self.warnings.append("Manifest has not changed since last indexed. No work done.")
             return True
 
@@ -202,24 +299,75 @@ class ManifestImporter:
         except ManifestImportError:
             return self._exit(ERROR_MAP['FAILED_VALIDATION'].code)
 
+        # Leave the indexing to the buffer if we have one.
+        if index_buffer is not None:
+            self._build_solr_doc()
+            index_buffer.add(self)
+            return True
+
         # Try to index it in solr and mark it as error it fails.
         try:
             self._solr_index()
         except scorched.exc.SolrError:
             return self._exit(ERROR_MAP['SOLR_INDEX_FAIL'].code)
 
+        return self._finish_import()
+
+    def reindex(self, index_buffer=None):
+        """Rebuild and index the solr document of an indexed manifest.
+
+        Only for importers from get_reindexer(). Their stored manifest was
+        validated and corrected when it was imported, so it is trusted:
+        retrieval, validation and source resolution are skipped, and the
+        database row is left as it is, even if indexing fails. A failure is
+        only recorded in self.errors.
+
+        Return False if error hit, True otherwise."""
+        self._build_solr_doc()
+        if index_buffer is not None:
+            index_buffer.add(self)
+            return True
+
+        try:
+            get_solr_interface(settings.SOLR_SERVER).add(self.doc)
+        except scorched.exc.SolrError:
+            return self._index_failed()
+
+        return self._finish_import()
+
+    def _finish_import(self):
+        """Record the successful indexing of this manifest and return True."""
+        if self.trusted:
+            # Only the solr document changed.
+            if self.bump_search_cache:
+                search_cache.bump_generation()
+            return True
+
         self.db_rep.manifest_hash = self.manifest_hash
+        if self.etag is not None:
+            self.db_rep.remote_etag = self.etag
+            self.db_rep.remote_last_modified = self.last_modified
         self.db_rep.indexed = True
         self.db_rep.source = self._find_source()
         self.db_rep.reset_validity()
         self.db_rep.save()
+        search_cache.bump_generation()
 
         self.alert_succeeded_import()
         return True
 
+    def _index_failed(self):
+        """Record that the solr document of this manifest could not be indexed."""
+        self.index_failed = True
+        self.errors.append(ERROR_MAP['SOLR_INDEX_FAIL'].msg)
+        return self._exit(ERROR_MAP['SOLR_INDEX_FAIL'].code)
+
     def _exit(self, error_code):
-        """Make sure record of failed import is saved and return false."""
-        if self.db_rep:
+        """Make sure record of failed import is saved and return false.
+
+        The row of a trusted reindex is not touched: a failure to reindex
+        says nothing about the manifest itself."""
+        if self.db_rep and not self.trusted:
             self.db_rep.is_valid = False
             self.db_rep.error = error_code
             self.db_rep.last_tested = timezone.now()
@@ -235,12 +383,18 @@ class ManifestImporter:
 
     def __validate(self):
         """Validate for proper IIIF API formatting"""
-        from misirlou.helpers.manifest_utils.library_specific_exceptions import get_validator
+        from misirlou.helpers.manifest_utils.library_specific_exceptions import get_validator, VALIDATORS
         v = get_validator(self.remote_url)
         v.logger.disabled = True
         v.fail_fast = True
         v.validate(self.json)
         if v.is_valid:
+            # Library specific validators may correct the document in place,
+            # so only an unchanged result of the generic one still matches
+            # the downloaded bytes.
+            netloc = urllib.parse.urlparse(self.remote_url).netloc
+            if netloc in VALIDATORS or v.corrected_doc != self.json:
+                self.raw_json = None
             self.json = v.corrected_doc
             self.warnings.extend(str(warn) for warn in v.warnings)
             return
@@ -248,7 +402,7 @@ class ManifestImporter:
             self.errors.extend(str(err) for err in v.errors)
             raise ManifestImportError
 
-    def _retrieve_json(self, force=False):
+    def _retrieve_json(self, force=False, conditional=False, parse_unchanged=True):
         """Download and parse json from remote.
 
         Change remote_url to the manifests @id (which is the
@@ -258,21 +412,54 @@ class ManifestImporter:
         :kwargs:
             -force: If true, will fetch resource even if object already
                 has it.
+            -conditional: If true, and the indexed manifest has stored
+                validators, ask the remote to answer '304 Not Modified' if
+                it has not changed. In that case self.not_modified is set
+                and nothing is downloaded or parsed.
+            -parse_unchanged: If false, a body with the same hash as the
+                indexed manifest is not parsed (see _is_unchanged()), as it
+                will not be validated or indexed again.
         """
         if not self.json or force:
+            headers = {}
+            if conditional and self.db_rep and self.db_rep.indexed:
+                headers = self.db_rep.conditional_headers()
             try:
-                manifest_resp = get_doc(self.remote_url)
+                manifest_resp = get_doc(self.remote_url, headers=headers)
             except requests.exceptions.Timeout:
                 self.errors.append(timeout_error.format(self.remote_url))
                 raise ManifestImportError
-            manifest_data = manifest_resp.text
-            self.manifest_hash = self.generate_manifest_hash(manifest_data)
+            if headers and manifest_resp.status_code == 304:
+                self.not_modified = True
+                return
+            self.etag = manifest_resp.headers.get('ETag', '')
+            self.last_modified = manifest_resp.headers.get('Last-Modified', '')
+            # Hash and parse the raw bytes, so the body is never decoded to text.
+            manifest_data = manifest_resp.content
+            self.manifest_hash = self.response_hash(manifest_resp, self.db_rep)
+            self.raw_json = manifest_data
+            if not parse_unchanged and self._is_unchanged():
+                return
             self.json = json.loads(manifest_data)
 
         doc_id = self.json.get("@id")
         if self._compare_url_id(self.remote_url, doc_id):
             self.remote_url = self.json.get('@id')
 
+    def _is_unchanged(self):
+        """Check if the fetched manifest has the hash of the indexed one."""
+        return bool(self.db_rep and self.db_rep.indexed
+                    and self.db_rep.manifest_hash == self.manifest_hash)
+
+    def _save_remote_validators(self):
+        """Store the ETag and Last-Modified headers of the last fetch, if any."""
+        if self.etag is None or not self.db_rep:
+            return
+        self.db_rep.remote_etag = self.etag
+        self.db_rep.remote_last_modified = self.last_modified
+        Manifest.objects.filter(pk=self.db_rep.pk).update(remote_etag=self.etag,
+                                                          remote_last_modified=self.last_modified)
+
     def _compare_url_id (self, remote_url, doc_id):
         """Check that rem_url and documents @id have the same netloc.
 
@@ -289,43 +476,67 @@ class ManifestImporter:
     def _find_existing_db_rep(self):
         """Check for duplicate in the DB and take its info it if exists.
 
-        Use the netloc and path of the given url as a search for an existing
-        manifest. If one is found, upgrade its url to https if possible.
+        Look up an existing manifest by the netloc and path of the given url
+        (its normalized_url). If one is found, upgrade its url to https if
+        possible.
 
         Assumes that all manifest url's will be http or https and will not have query parameters.
 
         :return True if we already have this exact Manifest, False otherwise.
         """
-        parsed = urllib.parse.urlparse(self.remote_url)
-        new_scheme = parsed[0]
-        netloc_and_path = "".join(parsed[1:3])
+        new_scheme = urllib.parse.urlparse(self.remote_url)[0]
         try:
-            old_entry = Manifest.objects.get(remote_url__contains=netloc_and_path)
-            parsed2 = urllib.parse.urlparse(old_entry.remote_url)
-            old_scheme = parsed2[0]
-            if old_scheme == 'http' and new_scheme == 'https':
-                old_entry.remote_url = self.remote_url
-                old_entry.save()
-            else:
-                self.remote_url = old_entry.remote_url
+            old_entry = Manifest.objects.get(normalized_url=get_basic_url(self.remote_url))
         except django_exceptions.ObjectDoesNotExist:
             return False
-        except django_exceptions.MultipleObjectsReturned:
-            raise django_exceptions.MultipleObjectsReturned("More than one manifest exists in the database with this remote_url!")
+
+        old_scheme = urllib.parse.urlparse(old_entry.remote_url)[0]
+        if old_scheme == 'http' and new_scheme == 'https':
+            old_entry.remote_url = self.remote_url
+            old_entry.save()
         else:
-            self.db_rep = old_entry
-            self.id = str(old_entry.id)
-            return True
+            self.remote_url = old_entry.remote_url
+        self.db_rep = old_entry
+        self.id = str(old_entry.id)
+        return True
 
     @staticmethod
-    def generate_manifest_hash(manifest_text):
-        """Compute and return a hash for the manifest text."""
-        return hashlib.sha1(manifest_text.encode('utf-8')).hexdigest()
+    def generate_manifest_hash(manifest_data):
+        """Compute and return a hash for the manifest bytes (or text).
+
+        Text is hashed as its utf-8 encoding, so the hash of a utf-8 body is
+        the same whether it is hashed as bytes or as decoded text.
+        """
+        if isinstance(manifest_data, str):
+            manifest_data = manifest_data.encode('utf-8')
+        return hashlib.sha1(manifest_data).hexdigest()
+
+    @classmethod
+    def response_hash(cls, resp, db_rep=None):
+        """Compute the hash of a response body, upgrading db_rep's legacy hash.
+
+        Hashes used to be taken from resp.text encoded as utf-8. That differs
+        from the raw bytes for non-ascii manifests served as text/* without
+        a charset, which requests decodes as ISO-8859-1. If the stored hash
+        of db_rep is the legacy hash of this same response, it is replaced
+        by the hash of the bytes, so the manifest is not seen as changed.
+        """
+        manifest_hash = cls.generate_manifest_hash(resp.content)
+        stored_hash = db_rep.manifest_hash if db_rep else ""
+        if stored_hash and stored_hash != manifest_hash \
+                and cls.generate_manifest_hash(resp.text) == stored_hash:
+            db_rep.manifest_hash = manifest_hash
+            Manifest.objects.filter(pk=db_rep.pk).update(manifest_hash=manifest_hash)
+        return manifest_hash
 
     def _solr_index(self):
         """Parse values from manifest and index in solr"""
-        solr_con = scorched.SolrInterface(settings.SOLR_SERVER)
+        solr_con = get_solr_interface(settings.SOLR_SERVER)
+        self._build_solr_doc()
+        solr_con.add(self.doc)
 
+    def _build_solr_doc(self):
+        """Parse values from manifest into self.doc, ready to be indexed."""
         self.doc = {'id': self.id,
                     'type': self.json.get('@type'),
                     'remote_url': self.remote_url,
@@ -384,15 +595,19 @@ class ManifestImporter:
             self.doc['logo'] = json.dumps(logo)
 
         self.doc = self._remove_html(self.doc)
-        self.doc['manifest'] = json.dumps(self.json)
-
-        solr_con.add(self.doc)
+        if self.raw_json is None:
+            self.doc['manifest'] = json.dumps(self.json)
+        elif isinstance(self.raw_json, bytes):
+            self.doc['manifest'] = self.raw_json.decode('utf-8')
+        else:
+            self.doc['manifest'] = self.raw_json
+        self.raw_json = None
 
     def _remove_html(self, doc):
         """Return a copy of the doc with html removed from all fields."""
         def recurse(field):
             if isinstance(field, str):
-                return strip_tags(field)
+                return strip_html(field)
             elif isinstance(field, (list)):
                 return [recurse(x) for x in field]
             elif isinstance(field, dict):
@@ -424,6 +639,8 @@ class ManifestImporter:
         resource = branch.get('resource')
         if resource:
             if resource.get('item'):
+                # Copy it, as the manifest itself must not be changed.
+                resource = dict(resource)
                 del resource['item']
             return json.dumps(resource)
 
@@ -437,7 +654,7 @@ class ManifestImporter:
 
     def _solr_delete(self):
         """ Delete document of self from solr"""
-        solr_con = scorched.SolrInterface(settings.SOLR_SERVER)
+        solr_con = get_solr_interface(settings.SOLR_SERVER)
         solr_con.delete_by_ids([self.id])
 
 
@@ -593,18 +810,27 @@ class IIIFMetadataParser:
         return result_list
 
 
-def get_importer(uri, prefetched_data=None):
-    """Return a ManifestImporter with settings for a specific library."""
-    import misirlou.helpers.manifest_utils.library_specific_exceptions as libraries
+def get_reindexer(manifest, text=None):
+    """Return an importer to rebuild the solr document of an indexed manifest from its stored copy.
 
-    parsed = urllib.parse.urlparse(uri)
-    netloc = parsed.netloc
+    :param text: The stored manifest, if it was already fetched from solr.
+
+    See ManifestImporter.reindex().
+    """
+    # Only the indexed fields and the canvases used for the thumbnail are parsed.
+    if text is None:
+        text = manifest.get_stored_manifest(to_json=False)
+    importer = get_importer(manifest.remote_url)
+    importer.json = scan_manifest(text, indexed_fields)
+    importer.raw_json = text
+    importer.id = str(manifest.id)
+    importer.db_rep = manifest
+    importer.manifest_hash = manifest.manifest_hash
+    importer.trusted = True
+    return importer
 
-    if netloc == "gallica.bnf.fr":
-        importer = libraries.get_gallica_bnf_fr_importer()
-    elif netloc == "iiif.archivelab.org":
-        importer = libraries.get_archivelab_org_importer()
-    else:
-        importer = ManifestImporter
 
-    return importer(uri, prefetched_data=prefetched_data)
+def get_importer(uri, prefetched_data=None):
+    """Return a ManifestImporter with settings for a specific library."""
+    from misirlou.helpers.manifest_utils.library_specific_exceptions import get_importer_class
+    return get_importer_class(uri)(uri, prefetched_data=prefetched_data)
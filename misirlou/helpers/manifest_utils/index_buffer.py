@@ -0,0 +1,97 @@
+import time
+import requests
+import scorched
+
+from django.conf import settings
+
+from misirlou.helpers.solr import get_solr_interface
+
+
+class SolrIndexBuffer:
+    """Collect the solr documents of importers and index them in batches.
+
+    Importers are added with add() once their document has been built (see
+    ManifestImporter.create(index_buffer=...)). The buffer is flushed when it
+    holds max_docs documents, or when a document is added more than
+    max_seconds after the oldest buffered one. Documents are sent with
+    commitWithin rather than an explicit commit, so solr can group the
+    commits of many batches.
+
+    After a flush, every importer is told whether its document was indexed.
+    If solr rejects a batch, its documents are retried one at a time so that
+    only the importers with a bad document fail with SOLR_INDEX_FAIL. An
+    importer whose _finish_import() or _index_failed() raises is marked as
+    failed on its own.
+
+    Use it as a context manager to make sure the last batch is flushed.
+    """
+
+    def __init__(self, solr_url=None, max_docs=None, max_seconds=None, commit_within=None):
+        self.solr_url = solr_url if solr_url else settings.SOLR_SERVER
+        self.max_docs = max_docs if max_docs else settings.SOLR_INDEX_BATCH_SIZE
+        self.max_seconds = max_seconds if max_seconds else settings.SOLR_INDEX_BATCH_SECONDS
+        self.commit_within = commit_within if commit_within else settings.SOLR_COMMIT_WITHIN_MS
+        self._pending = []
+        self._oldest = None
+        self._solr_con = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, importer):
+        """Buffer the document of an importer, flushing if the buffer is due."""
+        if not self._pending:
+            self._oldest = time.time()
+        self._pending.append(importer)
+        if len(self._pending) >= self.max_docs or time.time() - self._oldest >= self.max_seconds:
+            self.flush()
+
+    def flush(self):
+        """Index all buffered documents and report the result to their importers."""
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+
+        try:
+            self._add([imp.doc for imp in pending])
+        except (scorched.exc.SolrError, requests.exceptions.RequestException):
+            for imp in pending:
+                self._add_one(imp)
+        else:
+            for imp in pending:
+                self._finish(imp)
+
+    def _add_one(self, importer):
+        try:
+            self._add(importer.doc)
+        except (scorched.exc.SolrError, requests.exceptions.RequestException):
+            self._fail(importer)
+        else:
+            self._finish(importer)
+
+    def _fail(self, importer):
+        """Fail an import that was not indexed, even if recording the failure raises."""
+        try:
+            importer._index_failed()
+        except Exception as e:
+            importer.index_failed = True
+            importer.errors.append(str(e))
+
+    def _finish(self, importer):
+        """Finish an indexed import, so one failure can't stop the rest of the batch."""
+        try:
+            importer._finish_import()
+        except Exception as e:
+            importer.index_failed = True
+            importer.errors.append(str(e))
+
+    def _add(self, docs):
+        if self._solr_con is None:
+            self._solr_con = get_solr_interface(self.solr_url)
+        self._solr_con.add(docs, chunk=self.max_docs, commitWithin=self.commit_within)
@@ -1,16 +1,19 @@
 """This module defines special handling for manifests from specific libraries.
 
-All functions should return a IIIFValidator() instance to be used by the
-validator.
-
 These functions specify exceptions and corrections to be made during validation
 and indexing based on the systematic faults of manifests hosted by specific libraries.
-They do this by patching subclassing resource validators, creating them, then
-passing them into a IIIFValidator for use.
+They do this by subclassing resource validators and returning them in a dict
+of IIIFValidator attribute names to classes. get_validator() then creates a
+IIIFValidator using them.
 
-Functions which return IIIFValidators should be named get_[netloc]_validator,
+Functions which return validator classes should be named get_[netloc]_validator,
 where [netloc] is the hostname of the library website. Function which return
-ManifestImporters should be named get_[netloc]_importer.
+ManifestImporters should be named get_[netloc]_importer. They are cached, so
+their classes are only created once per process, and must be registered by
+hostname in VALIDATORS or IMPORTERS.
+
+Patches must stay in the subclasses they return: never modify the tripoli
+base classes, as that would apply the patch to every library.
 
 If possible (e.g., if all that is required is adding/removing/modifying the
 return value of a particular section), the original function should be called
@@ -24,30 +27,42 @@ erroneous corrections.
 Include a doc string for every over-ridden function explaining its purpose.
 """
 import urllib.parse
+from functools import lru_cache
 
 from misirlou.helpers.manifest_utils.importer import ManifestImporter
 from tripoli import IIIFValidator, ManifestValidator, CanvasValidator, AnnotationValidator, SequenceValidator
 from tripoli.resource_validators.image_content_validator import ImageContentValidator
-from tripoli.resource_validators.base_validator import BaseValidator
 
 
+@lru_cache()
 def get_harvard_edu_validator():
-    def str_to_int(self, field, value):
-        """Coerce strings to ints."""
-        if isinstance(value, int):
-            return value
-        try:
-            val = int(value)
-            self.log_warning(field, "Coerced to int.")
-            return val
-        except ValueError:
-            self.log_error(field, "Could not coerce to int.")
-            return value
-
-    BaseValidator.width_field = lambda self, value: str_to_int(self, "width", value)
-    BaseValidator.height_field = lambda self, value: str_to_int(self, "height", value)
-
-    class PatchedImageContentValidator(ImageContentValidator):
+    class CoerceDimensionsMixin:
+        """Coerce string widths and heights to ints."""
+        def str_to_int(self, field, value):
+            """Coerce strings to ints."""
+            if isinstance(value, int):
+                return value
+            try:
+                val = int(value)
+                self.log_warning(field, "Coerced to int.")
+                return val
+            except ValueError:
+                self.log_error(field, "Could not coerce to int.")
+                return value
+
+        def width_field(self, value):
+            return self.str_to_int("width", value)
+
+        def height_field(self, value):
+            return self.str_to_int("height", value)
+
+    class PatchedCanvasValidator(CoerceDimensionsMixin, CanvasValidator):
+        pass
+
+    class PatchedAnnotationValidator(CoerceDimensionsMixin, AnnotationValidator):
+        pass
+
+    class PatchedImageContentValidator(CoerceDimensionsMixin, ImageContentValidator):
         def service_field(self, value):
             """Add a context to the service if none exists."""
             val, errs = self.mute_errors(super().service_field, value)
@@ -73,12 +88,13 @@ def get_harvard_edu_validator():
 
             return super().license_field(value)
 
-    iv = IIIFValidator()
-    iv.ManifestValidator = PatchedManifestValidator
-    iv.ImageContentValidator = PatchedImageContentValidator
-    return iv
+    return {'ManifestValidator': PatchedManifestValidator,
+            'CanvasValidator': PatchedCanvasValidator,
+            'AnnotationValidator': PatchedAnnotationValidator,
+            'ImageContentValidator': PatchedImageContentValidator}
 
 
+@lru_cache()
 def get_vatlib_it_validator():
     class PatchedAnnotationValidator(AnnotationValidator):
         def setup(self):
@@ -92,16 +108,11 @@ def get_vatlib_it_validator():
                 if val == "paged":
                     self.log_warning("viewingHint", "Applied library specific corrections. Allowed value 'paged'.")
 
-    iv = IIIFValidator()
-    iv.AnnotationValidator = PatchedAnnotationValidator
-    iv.CanvasValidator = PatchedCanvasValidator
-    return iv
-
-
-def get_stanford_edu_validator():
-    return get_harvard_edu_validator()
+    return {'AnnotationValidator': PatchedAnnotationValidator,
+            'CanvasValidator': PatchedCanvasValidator}
 
 
+@lru_cache()
 def get_archivelab_org_validator():
     class PatchedManifestValidator(ManifestValidator):
         # Replace the image API with the presentation API at manifest level.
@@ -123,13 +134,12 @@ def get_archivelab_org_validator():
         def setup(self):
             self.ImageSchema['type'] = self.type_field
 
-    iv = IIIFValidator()
-    iv.ManifestValidator = PatchedManifestValidator
-    iv.AnnotationValidator = PatchedAnnotationValidator
-    iv.SequenceValidator = PatchedSequenceValidator
-    return iv
+    return {'ManifestValidator': PatchedManifestValidator,
+            'AnnotationValidator': PatchedAnnotationValidator,
+            'SequenceValidator': PatchedSequenceValidator}
 
 
+@lru_cache()
 def get_archivelab_org_importer():
     class PatchedManifestImporter(ManifestImporter):
         def _default_thumbnail_finder(self):
@@ -139,6 +149,7 @@ def get_archivelab_org_importer():
     return PatchedManifestImporter
 
 
+@lru_cache()
 def get_gallica_bnf_fr_validator():
 
     class PatchedManifestValidator(ManifestValidator):
@@ -158,11 +169,10 @@ def get_gallica_bnf_fr_validator():
                                                      "metadata field bad formatting ignored.")
             return values
 
-    iv = IIIFValidator()
-    iv.ManifestValidator = PatchedManifestValidator
-    return iv
+    return {'ManifestValidator': PatchedManifestValidator}
 
 
+@lru_cache()
 def get_gallica_bnf_fr_importer():
     class PatchedManifestImporter(ManifestImporter):
         def _default_thumbnail_finder(self, force_IIIF=True):
@@ -171,26 +181,32 @@ def get_gallica_bnf_fr_importer():
     return PatchedManifestImporter
 
 
-def get_wdl_org_validator():
-    return get_harvard_edu_validator()
+# Hostnames of libraries with special handling.
+VALIDATORS = {
+    "iiif.lib.harvard.edu": get_harvard_edu_validator,
+    "digi.vatlib.it": get_vatlib_it_validator,
+    "purl.stanford.edu": get_harvard_edu_validator,
+    "iiif.archivelab.org": get_archivelab_org_validator,
+    "gallica.bnf.fr": get_gallica_bnf_fr_validator,
+    "www.wdl.org": get_harvard_edu_validator,
+}
+IMPORTERS = {
+    "gallica.bnf.fr": get_gallica_bnf_fr_importer,
+    "iiif.archivelab.org": get_archivelab_org_importer,
+}
 
 
 def get_validator(uri):
     """Configure a schemas based on settings relevant to given uri."""
+    iv = IIIFValidator()
+    get_classes = VALIDATORS.get(urllib.parse.urlparse(uri).netloc)
+    if get_classes:
+        for name, cls in get_classes().items():
+            setattr(iv, name, cls)
+    return iv
+
 
-    parsed = urllib.parse.urlparse(uri)
-    netloc = parsed.netloc
-    if netloc == "iiif.lib.harvard.edu":
-        return get_harvard_edu_validator()
-    if netloc == "digi.vatlib.it":
-        return get_vatlib_it_validator()
-    if netloc == "purl.stanford.edu":
-        return get_stanford_edu_validator()
-    if netloc == "iiif.archivelab.org":
-        return get_archivelab_org_validator()
-    if netloc == "gallica.bnf.fr":
-        return get_gallica_bnf_fr_validator()
-    if netloc == "www.wdl.org":
-        return get_wdl_org_validator()
-
-    return IIIFValidator()
+def get_importer_class(uri):
+    """Get the ManifestImporter class to use for the given uri."""
+    get_class = IMPORTERS.get(urllib.parse.urlparse(uri).netloc)
+    return get_class() if get_class else ManifestImporter
@@ -0,0 +1,203 @@
+"""Extract parts of a serialized manifest without parsing all of it.
+
+Indexing a stored manifest only needs a few top-level fields and a single
+canvas, but a manifest with thousands of canvases takes many times its own
+size in memory once parsed. scan_manifest() steps over the JSON text once
+and only parses the requested fields. The canvases of the first sequence are
+only located, and each one is parsed when it is indexed. The scan stops as
+soon as the fields and the canvases are found. Manifests small enough to be
+parsed cheaply are parsed whole instead.
+
+The text must be valid JSON (e.g., a manifest stored after validation).
+Malformed text raises a ManifestScanError.
+"""
+import re
+import ujson as json
+
+# Texts shorter than this are parsed whole, which is faster than scanning.
+SCAN_MIN_LENGTH = 1 << 20
+
+_WHITESPACE = re.compile(r'\s*')
+_STRING = re.compile(r'"(?:[^"\\]|\\.)*"', re.DOTALL)
+_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"|[\[\]{}]', re.DOTALL)
+_SCALAR = re.compile(r'[^,\]}\s]+')
+
+
+class ManifestScanError(ValueError):
+    pass
+
+
+class ScannedCanvases:
+    """Read-only list of canvases, each parsed from the text when indexed."""
+
+    def __init__(self, text, spans):
+        self._text = text
+        self._spans = spans
+
+    def __len__(self):
+        return len(self._spans)
+
+    def __getitem__(self, index):
+        start, end = self._spans[index]
+        return json.loads(self._text[start:end])
+
+
+def scan_manifest(text, fields, min_length=SCAN_MIN_LENGTH):
+    """Parse the given top-level fields and locate the canvases of a manifest.
+
+    :param text: Serialized manifest (str).
+    :param fields: Iterable of top-level keys to parse.
+    :param min_length: Texts shorter than this are parsed whole.
+    :return: Dict of the found fields. If the manifest has sequences, its
+        'sequences' is a list holding the first sequence as a dict whose only
+        key, 'canvases', is the list of its canvases (a ScannedCanvases if
+        the text was scanned).
+    """
+    fields = set(fields)
+    if len(text) < min_length:
+        return _parse_manifest(text, fields)
+    try:
+        return _scan_manifest(text, fields)
+    except IndexError:
+        raise ManifestScanError("Unexpected end of manifest.")
+
+
+def _parse_manifest(text, fields):
+    """Get the same result as _scan_manifest() by parsing the whole text."""
+    try:
+        manifest = json.loads(text)
+    except ValueError as e:
+        raise ManifestScanError(str(e))
+    if not isinstance(manifest, dict):
+        raise ManifestScanError("Expected an object at 0.")
+    result = {key: manifest[key] for key in fields if key in manifest}
+    sequences = manifest.get('sequences')
+    if sequences and 'sequences' not in fields:
+        result['sequences'] = [{'canvases': sequences[0].get('canvases', [])}]
+    return result
+
+
+def _scan_manifest(text, fields):
+    result = {}
+    pos = _enter(text, 0, '{')
+    more = text[pos] != '}'
+    while more:
+        key, start = _read_key(text, pos)
+        if key in fields:
+            end = _value_end(text, start)
+            result[key] = json.loads(text[start:end])
+        elif key == 'sequences' and 'sequences' not in result:
+            spans, end = _scan_sequences(text, start)
+            if spans is not None:
+                result['sequences'] = [{'canvases': ScannedCanvases(text, spans)}]
+        else:
+            end = _value_end(text, start)
+        if 'sequences' in result and fields.issubset(result):
+            break
+        pos, more = _after(text, end, '}')
+    return result
+
+
+def _scan_sequences(text, pos):
+    """Get the spans of the canvases of the first sequence in the array at pos.
+
+    :return: Tuple of the spans (None if there is no sequence) and the index
+        just past the array.
+    """
+    pos = _enter(text, pos, '[')
+    if text[pos] == ']':
+        return None, pos + 1
+    spans = []
+    pos = _enter(text, pos, '{')
+    more = text[pos] != '}'
+    if not more:
+        pos += 1
+    while more:
+        key, start = _read_key(text, pos)
+        if key == 'canvases' and not spans:
+            end = _scan_array(text, start, spans)
+        else:
+            end = _value_end(text, start)
+        pos, more = _after(text, end, '}')
+
+    # Any other sequences are skipped.
+    pos, more = _after(text, pos, ']')
+    while more:
+        pos, more = _after(text, _value_end(text, pos), ']')
+    return spans, pos
+
+
+def _scan_array(text, pos, spans):
+    """Append the (start, end) of every element of the array at pos to spans.
+
+    :return: The index just past the array.
+    """
+    pos = _enter(text, pos, '[')
+    if text[pos] == ']':
+        return pos + 1
+    more = True
+    while more:
+        end = _value_end(text, pos)
+        spans.append((pos, end))
+        pos, more = _after(text, end, ']')
+    return pos
+
+
+def _enter(text, pos, opening):
+    """Get the index of the first member of the object or array at pos."""
+    pos = _skip_whitespace(text, pos)
+    if text[pos] != opening:
+        raise ManifestScanError("Expected '{}' at {}.".format(opening, pos))
+    return _skip_whitespace(text, pos + 1)
+
+
+def _read_key(text, pos):
+    """Get the key of the object member at pos, and the index of its value."""
+    match = _STRING.match(text, pos)
+    if not match:
+        raise ManifestScanError("Expected a key at {}.".format(pos))
+    pos = _skip_whitespace(text, match.end())
+    if text[pos] != ':':
+        raise ManifestScanError("Expected ':' at {}.".format(pos))
+    return json.loads(match.group()), _skip_whitespace(text, pos + 1)
+
+
+def _after(text, end, closing):
+    """Step over the separator after the member ending at end.
+
+    :return: Tuple of the index of the next member and True, or of the
+        index just past the closing bracket and False.
+    """
+    pos = _skip_whitespace(text, end)
+    if text[pos] == closing:
+        return pos + 1, False
+    if text[pos] != ',':
+        raise ManifestScanError("Expected ',' or '{}' at {}.".format(closing, pos))
+    return _skip_whitespace(text, pos + 1), True
+
+
+def _value_end(text, pos):
+    """Get the index just past the value starting at pos."""
+    char = text[pos]
+    if char == '"':
+        match = _STRING.match(text, pos)
+    elif char in '{[':
+        depth = 0
+        for match in _TOKEN.finditer(text, pos):
+            token = match.group()
+            if token in ('{', '['):
+                depth += 1
+            elif token in ('}', ']'):
+                depth -= 1
+                if not depth:
+                    return match.end()
+        match = None
+    else:
+        match = _SCALAR.match(text, pos)
+    if not match:
+        raise ManifestScanError("Malformed value at {}.".format(pos))
+    return match.end()
+
+
+def _skip_whitespace(text, pos):
+    return _WHITESPACE.match(text, pos).end()
@@ -7,7 +7,6 @@ considered critical, and the manifest should be hidden until the error is
 addressed. Warnings are non-critical issues that may effect the user experience
 negatively.
 """
-import scorched
 import ujson as json
 import requests
 import uuid
@@ -21,6 +20,7 @@ import misirlou.models as models
 from misirlou.helpers.manifest_utils.importer import ManifestImporter
 from misirlou.helpers.manifest_utils.errors import ErrorMap
 from misirlou.helpers.requester import DEFAULT_REQUESTER
+from misirlou.helpers.solr import get_solr_interface
 
 
 class ManifestTesterException(Exception):
@@ -60,11 +60,10 @@ class ManifestTester:
         self.error = None
         self.local_json = None
         self.solr_resp = None
-        self.remote_json = None
         self.remote_hash = None
         self.orm_object = None
         self._is_valid = None
-        self._solr_conn = scorched.SolrInterface(settings.SOLR_SERVER)
+        self._solr_conn = get_solr_interface(settings.SOLR_SERVER)
 
         for k, v in kwargs.items():
             if (k.startswith('WARN') or k.startswith('RAISE')) and\
@@ -149,30 +148,38 @@ class ManifestTester:
     def _retrieve_remote_manifest(self):
         """Test the ability to fetch this manifest from the remote.
 
-        An SHA1 hash is computed and stored in self.remote_hash.
-        The manifest at the location is stored as self.remote_json.
+        An SHA1 hash is computed and stored in self.remote_hash. The
+        manifest itself is not parsed.
+
+        The request is conditional on the stored ETag and Last-Modified
+        validators. If the remote answers '304 Not Modified', the stored
+        hash is taken as the remote hash and nothing is downloaded.
         """
         remote_url = self.local_json['@id']
 
         if not remote_url.startswith('https'):
             self._handle_err("HTTPS_STORED")
 
+        headers = self.orm_object.conditional_headers() if self.orm_object else {}
         resp = None
         try:
-            resp = requester.get(remote_url, timeout=20)
+            resp = requester.get(remote_url, timeout=20, headers=headers)
         except requests.exceptions.SSLError:
             self._handle_err("MANIFEST_SSL_FAILURE")
         if not resp:
             try:
-                resp = requester.get(remote_url, verify=False, timeout=20)
+                resp = requester.get(remote_url, verify=False, timeout=20, headers=headers)
             except requests.exceptions.Timeout:
                 self._handle_err("TIMEOUT_REMOTE_RETRIEVAL")
 
+        if headers and resp.status_code == 304:
+            self.remote_hash = self.orm_object.manifest_hash
+            return
+
         if (resp.status_code < 200 or resp.status_code >= 400) and self.RAISE_FAILED_REMOTE_RETRIEVAL:
             self._handle_err("FAILED_REMOTE_RETRIEVAL")
 
-        self.remote_hash = ManifestImporter.generate_manifest_hash(resp.text)
-        self.remote_json = json.loads(resp.text)
+        self.remote_hash = ManifestImporter.response_hash(resp, self.orm_object)
 
     def _compare_manifest_hashes(self):
         """Test that the stored hash is equal to the contents at the remote.
@@ -1,5 +1,18 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import lru_cache
 from urllib.parse import urlparse
 
+from django.utils.html import strip_tags
+
+# Longer strings are cached by digest, so the cache doesn't keep them whole.
+_CACHED_MAX_LENGTH = 1024
+# Number of long strings whose stripped value is cached.
+_LONG_CACHE_SIZE = 256
+_long_cache = OrderedDict()
+_long_cache_lock = threading.Lock()
+
 
 def parse_lang_value(value, lang="en"):
     """Parse a value with preference for specified language.
@@ -71,3 +84,37 @@ def get_basic_url(remote_url):
     parsed = urlparse(remote_url)
     return "".join(parsed[1:3])
 
+
+def strip_html(value):
+    """Remove html tags from a string with django's strip_tags.
+
+    Strings without a '<' are returned as they are, as strip_tags would
+    return them. Results are memoized, since values such as attributions
+    and long descriptions repeat across many manifests. Long strings are
+    looked up by their SHA1 digest, so only their stripped value is kept.
+    """
+    if '<' not in value:
+        return value
+    if len(value) > _CACHED_MAX_LENGTH:
+        return _strip_long(value)
+    return _cached_strip_tags(value)
+
+
+@lru_cache(maxsize=2048)
+def _cached_strip_tags(value):
+    return strip_tags(value)
+
+
+def _strip_long(value):
+    digest = hashlib.sha1(value.encode('utf-8')).digest()
+    with _long_cache_lock:
+        stripped = _long_cache.get(digest)
+        if stripped is not None:
+            _long_cache.move_to_end(digest)
+            return stripped
+    stripped = strip_tags(value)
+    with _long_cache_lock:
+        _long_cache[digest] = stripped
+        if len(_long_cache) > _LONG_CACHE_SIZE:
+            _long_cache.popitem(last=False)
+    return stripped
@@ -0,0 +1,47 @@
+"""Encoding of the OMR regions stored in the solr OCR core.
+
+The location of a hit is stored in the (string) 'location' field as packed
+boxes: 'ulx,uly,width,height' joined by ';'. This can be split without a
+JSON parser. Documents indexed before this format have a python-style list
+of dicts instead (e.g., "[{'ulx': 1, 'uly': 2, 'width': 3, 'height': 4}]"),
+which is still understood until they are re-imported with import_omr.
+"""
+import ujson as json
+
+LOCATION_FIELDS = ('ulx', 'uly', 'width', 'height')
+REGION_URL = "{}/{},{},{},{}/full/0/default.jpg"
+
+
+def pack_location(location):
+    """Convert a location (legacy string or list of dicts) to the packed form."""
+    if isinstance(location, str):
+        if not location.startswith('['):
+            return location
+        location = json.loads(location.replace("'", '"'))
+    return ";".join(",".join(str(box[f]) for f in LOCATION_FIELDS) for box in location)
+
+
+def unpack_location(location):
+    """Get the list of (ulx, uly, width, height) boxes of a stored location."""
+    if location.startswith('['):
+        return [tuple(box[f] for f in LOCATION_FIELDS)
+                for box in json.loads(location.replace("'", '"'))]
+    return [tuple(int(v) for v in box.split(',')) for box in location.split(';') if box]
+
+
+def add_regions(docs, with_url=True):
+    """Replace the stored location of each doc with its list of boxes.
+
+    Boxes are returned as dicts, as the viewer expects. With with_url, each
+    doc also gets an 'easy_url' to the IIIF image of each of its boxes.
+
+    :param docs: List of solr docs from the OCR core, changed in place.
+    :return: The same list.
+    """
+    for doc in docs:
+        boxes = unpack_location(doc['location'])
+        doc['location'] = [dict(zip(LOCATION_FIELDS, box)) for box in boxes]
+        if with_url:
+            base = doc['image_url']
+            doc['easy_url'] = [REGION_URL.format(base, *box) for box in boxes]
+    return docs
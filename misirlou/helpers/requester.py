@@ -1,41 +1,95 @@
+import os
 import time
+import threading
 import requests
 import redis
-import redlock
+from requests.adapters import HTTPAdapter
 from urllib.parse import urlsplit
 
 from django.conf import settings
 
 
-def get_crawl_delay(domain):
-    """Figure out the lowest crawl delay in the robots.txt of this domain.
+# Never wait longer than this many seconds between gets (we're not *that* nice).
+MAX_CRAWL_DELAY = 30
+
+
+def parse_crawl_delay(robots_txt, user_agent=None):
+    """Return the crawl delay a robots.txt sets for a user agent, or None.
+
+    The file is read as records: one or more User-agent lines followed by
+    the rules which apply to them. The delay in a record naming our user
+    agent takes precedence over the delay in the '*' record. Agents are
+    compared by product token (the name before any '/version'), ignoring
+    case, so a record for 'music' does not apply to 'musiclibs'.
+
+    :param robots_txt: Text of a robots.txt file.
+    :param user_agent: Name of the user agent (defaults to REQUESTER_USER_AGENT).
+    """
+    user_agent = _product_token(user_agent if user_agent else settings.REQUESTER_USER_AGENT)
+    specific_delay = None
+    default_delay = None
+    agents = []
+    in_rules = False
+
+    for line in robots_txt.splitlines():
+        line = line.split('#', 1)[0].strip()
+        if ':' not in line:
+            continue
+        field, value = line.split(':', 1)
+        field = field.strip().lower()
+        value = value.strip()
+
+        if field == 'user-agent':
+            # A user-agent line after some rules starts a new record.
+            if in_rules:
+                agents = []
+                in_rules = False
+            agents.append(_product_token(value))
+            continue
+
+        in_rules = True
+        if field != 'crawl-delay':
+            continue
+        try:
+            delay = max(float(value), 0)
+        except ValueError:
+            continue
+        for agent in agents:
+            if agent == '*' and default_delay is None:
+                default_delay = delay
+            elif agent == user_agent and specific_delay is None:
+                specific_delay = delay
+
+    return specific_delay if specific_delay is not None else default_delay
+
+
+def _product_token(user_agent):
+    """Return the lowercased name of a user agent, without its version."""
+    return user_agent.split('/', 1)[0].strip().lower()
+
+
+def get_crawl_delay(domain, session=None):
+    """Figure out the crawl delay the robots.txt of this domain sets for us.
 
     If not present or not found, default to crawl-delay of 1. Max out at
-    waiting 30 seconds between gets (we're not *that* nice).
+    waiting MAX_CRAWL_DELAY seconds between gets.
+
+    :param session: Optional requests.Session to make the request with.
     """
     cd = 1
-    resp = None
+    getter = session if session is not None else requests
     try:
-        resp = requests.get('http://' + domain + '/robots.txt')
+        resp = getter.get('http://' + domain + '/robots.txt', timeout=10)
     # Don't actually care if this succeeds.
-    except:
-        pass
-    if resp is None or (resp and 300 >= resp.status_code):
+    except Exception:
+        return cd
+    if resp.status_code < 200 or resp.status_code >= 300:
         return cd
 
-    min_cd = 30
-    found = False
-    for line in resp.iter_lines():
-        line = line.decode('utf-8')
-        if line.startswith('Crawl-delay'):
-            try:
-                min_cd = min(min_cd, int(line.split(":")[-1]))
-                found = True
-            except ValueError:
-                continue
-    if found:
-        return min_cd
-    return cd
+    delay = parse_crawl_delay(resp.text)
+    if delay is None:
+        return cd
+    return min(delay, MAX_CRAWL_DELAY)
 
 
 def get_domain(url):
@@ -43,6 +97,108 @@ def get_domain(url):
     return o.netloc
 
 
+class SessionPool:
+    """Keeps one keep-alive requests.Session per domain.
+
+    Sessions which have not been used for idle_seconds are closed and
+    evicted. The pool is reset after a fork, so worker processes never
+    share sockets with their parent.
+    """
+
+    def __init__(self, pool_maxsize=None, idle_seconds=None):
+        self.pool_maxsize = pool_maxsize if pool_maxsize else settings.REQUESTER_POOL_MAXSIZE
+        self.idle_seconds = idle_seconds if idle_seconds else settings.REQUESTER_SESSION_IDLE_SECONDS
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def get_session(self, domain):
+        """Return the session for a domain, creating it if needed."""
+        now = time.time()
+        with self._lock:
+            if self._pid != os.getpid():
+                self._sessions = {}
+                self._pid = os.getpid()
+            self._evict_idle(now)
+            entry = self._sessions.get(domain)
+            session = entry[0] if entry else self._make_session()
+            self._sessions[domain] = (session, now)
+        return session
+
+    def close(self):
+        """Close all sessions in the pool."""
+        with self._lock:
+            for session, _ in self._sessions.values():
+                session.close()
+            self._sessions = {}
+
+    def _make_session(self):
+        session = requests.Session()
+        session.headers['User-Agent'] = settings.REQUESTER_USER_AGENT
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def _evict_idle(self, now):
+        for domain, (session, last_used) in list(self._sessions.items()):
+            if now - last_used > self.idle_seconds:
+                del self._sessions[domain]
+                session.close()
+
+
+class RobotsRegistry:
+    """Crawl delays from robots.txt, shared by all processes through redis.
+
+    A domain's robots.txt is fetched by a single process, and the resulting
+    delay is stored for ROBOTS_TXT_CACHE_SECONDS. Processes which miss the
+    cache while another is fetching wait for its result instead of
+    fetching robots.txt themselves.
+    """
+
+    # Seconds to sleep between checks for a delay being fetched by another process.
+    _poll_seconds = 0.2
+
+    # Seconds after which a process fetching robots.txt is assumed to have died.
+    _fetch_lock_seconds = 30
+
+    def __init__(self, redis_con, sessions):
+        self._redis = redis_con
+        self._sessions = sessions
+
+    def get(self, domain):
+        """Return the crawl delay of a domain, fetching it if no process has yet."""
+        delay_key = self._delay_key(domain)
+        delay = self._redis.get(delay_key)
+        if delay is not None:
+            return float(delay)
+
+        lock_key = delay_key + '_lock'
+        if self._redis.set(lock_key, 1, nx=True, ex=self._fetch_lock_seconds):
+            return self.refresh(domain)
+
+        # Another process is fetching this robots.txt, so wait for it.
+        deadline = time.time() + self._fetch_lock_seconds
+        while time.time() < deadline:
+            time.sleep(self._poll_seconds)
+            delay = self._redis.get(delay_key)
+            if delay is not None:
+                return float(delay)
+        return self.refresh(domain)
+
+    def refresh(self, domain):
+        """Fetch the robots.txt of a domain and store its crawl delay."""
+        delay_key = self._delay_key(domain)
+        delay = get_crawl_delay(domain, self._sessions.get_session(domain))
+        self._redis.set(delay_key, delay, ex=settings.ROBOTS_TXT_CACHE_SECONDS)
+        self._redis.delete(delay_key + '_lock')
+        return delay
+
+    @staticmethod
+    def _delay_key(domain):
+        return 'musiclibs_RRR_domain_crawl_delay{}'.format(domain)
+
+
 class DomainBasedRespectfulRequester:
     """Makes requests while attempting to respect a domains robots.txt"""
 
@@ -50,15 +206,18 @@ class DomainBasedRespectfulRequester:
         """Create a DomainBasedFuzzingRequester"""
         self._domain_crawl_delay = {}
         self._domain_last_hit_time = {}
+        self._sessions = SessionPool()
+
+    def crawl_delay(self, domain):
+        """Return the crawl delay of a domain, fetching it if we don't have it yet."""
+        if domain not in self._domain_crawl_delay:
+            self._domain_crawl_delay[domain] = get_crawl_delay(domain, self._sessions.get_session(domain))
+        return self._domain_crawl_delay[domain]
 
     def get(self, url, **kwargs):
         """Make a request with respect to the crawl-delay on a particular domain."""
-
-        # Figure out the crawl delay for this domain, if we don't have it yet.
         domain = get_domain(url)
-        if domain not in self._domain_crawl_delay:
-            self._domain_crawl_delay[domain] = get_crawl_delay(domain)
-        crawl_delay = self._domain_crawl_delay[domain]
+        crawl_delay = self.crawl_delay(domain)
 
         # Wait until next request at this domain is allowed
         if domain in self._domain_last_hit_time:
@@ -69,62 +228,91 @@ class DomainBasedRespectfulRequester:
 
         self._domain_last_hit_time[domain] = time.time()
 
-        # get the stuff using requests
-        resp = requests.get(url, **kwargs)
+        # get the stuff using this domain's pooled session
+        resp = self._sessions.get_session(domain).get(url, **kwargs)
         return resp
 
 
 class RedisRespectfulRequester(DomainBasedRespectfulRequester):
-    """Uses redis distributed lock to ensure multiprocess respectful requesting."""
+    """Uses an atomic redis reservation to ensure multiprocess respectful requesting.
 
-    # Amount of time a lock lasts on a domain. That is, lock expires no matter what after this many milliseconds.
-    _lock_timeout_milliseconds = 15000
+    Every request reserves the next free access slot on its domain with a
+    single call to a server-side script, then sleeps until that slot. No
+    locks are taken, so workers never spin waiting for each other.
+    """
 
-    # Amount of time to sleep between attempts to acquire lock. Makes lock acquisition less CPU intensive.
-    _spin_sleep_seconds = 0.2
+    # Reserve the next access slot on a domain and record how long it queued.
+    # KEYS[1]: next access time of the domain. KEYS[2]: wait stats of the domain.
+    # ARGV[1]: current time. ARGV[2]: seconds between requests to the domain.
+    # Returns the time (as a string) at which the caller may make its request.
+    _reserve_slot_lua = """
+        local now = tonumber(ARGV[1])
+        local delay = tonumber(ARGV[2])
+        local slot = math.max(now, tonumber(redis.call('GET', KEYS[1]) or '0'))
+        local next_access = slot + delay
+        redis.call('SET', KEYS[1], tostring(next_access), 'EX', math.ceil(next_access - now) + 60)
+
+        local wait = slot - now
+        redis.call('HINCRBY', KEYS[2], 'requests', 1)
+        redis.call('HINCRBYFLOAT', KEYS[2], 'wait_seconds', tostring(wait))
+        if wait > tonumber(redis.call('HGET', KEYS[2], 'max_wait_seconds') or '0') then
+            redis.call('HSET', KEYS[2], 'max_wait_seconds', tostring(wait))
+        end
+        return tostring(slot)
+    """
+
+    # Seconds to keep a crawl delay from the registry in process.
+    _local_delay_cache_seconds = 300
 
     def __init__(self):
         super().__init__()
         self._redis = redis.StrictRedis(host=settings.REDIS_HOST,
                                         port=settings.REDIS_PORT,
                                         db=settings.REDIS_SERVER)
-        self._redlock = redlock.Redlock([{"host": settings.REDIS_HOST,
-                                          "port": settings.REDIS_PORT,
-                                          "db": settings.REDIS_SERVER}, ])
+        self._reserve_slot = self._redis.register_script(self._reserve_slot_lua)
+        self.robots = RobotsRegistry(self._redis, self._sessions)
+
+    def crawl_delay(self, domain):
+        """Return the crawl delay of a domain from the shared robots.txt registry.
+
+        Delays are kept in process for a short while to save a redis round-trip
+        on every request.
+        """
+        cached = self._domain_crawl_delay.get(domain)
+        if cached and cached[1] > time.time():
+            return cached[0]
+        delay = self.robots.get(domain)
+        self._domain_crawl_delay[domain] = (delay, time.time() + self._local_delay_cache_seconds)
+        return delay
 
     def get(self, url, **kwargs):
         domain = get_domain(url)
-        if domain not in self._domain_crawl_delay:
-            self._domain_crawl_delay[domain] = get_crawl_delay(domain)
-        time_between_requests = self._domain_crawl_delay[domain]
-        domain_lock_key = 'musiclibs_RRR_domain_lock_{}'.format(domain)
+        time_between_requests = self.crawl_delay(domain)
         domain_next_access_key = 'musiclibs_RRR_domain_next_access{}'.format(domain)
+        domain_wait_stats_key = 'musiclibs_RRR_domain_wait_stats{}'.format(domain)
 
-        # Spin until we get a lock on this domain
-        lock = False
-        while True:
-            lock = self._redlock.lock(domain_lock_key, self._lock_timeout_milliseconds)
-            if lock:
-                break
-            else:
-                time.sleep(self._spin_sleep_seconds)
+        # Reserve a slot on this domain and wait until it comes up.
+        slot = self._reserve_slot(keys=[domain_next_access_key, domain_wait_stats_key],
+                                  args=[time.time(), time_between_requests])
+        wait_time = float(slot) - time.time()
+        if wait_time > 0:
+            time.sleep(wait_time)
 
-        try:
-            # Wait between each request to a domain.
-            next_access = self._redis.get(domain_next_access_key)
-            next_access = float(next_access) if next_access else 0.0
-            curr_time = time.time()
-            wait_time = 0
-            if next_access and next_access > curr_time:
-                wait_time = next_access - curr_time
-                time.sleep(wait_time)
+        # Get the thing.
+        return self._sessions.get_session(domain).get(url, **kwargs)
 
-            # Set the next access time and unlock the domain.
-            self._redis.set(domain_next_access_key, curr_time + wait_time + time_between_requests)
-        finally:
-            self._redlock.unlock(lock)
+    def queue_stats(self, domain):
+        """Return how long requests to a domain have queued for their slot.
 
-        # Get the thing.
-        return requests.get(url, **kwargs)
+        :return: Dict with the number of requests, the total and maximum
+            seconds spent waiting, and the mean wait per request.
+        """
+        stats = self._redis.hgetall('musiclibs_RRR_domain_wait_stats{}'.format(domain))
+        requests_count = int(stats.get(b'requests', 0))
+        wait_seconds = float(stats.get(b'wait_seconds', 0))
+        return {'requests': requests_count,
+                'wait_seconds': wait_seconds,
+                'max_wait_seconds': float(stats.get(b'max_wait_seconds', 0)),
+                'mean_wait_seconds': wait_seconds / requests_count if requests_count else 0.0}
 
 DEFAULT_REQUESTER = RedisRespectfulRequester()
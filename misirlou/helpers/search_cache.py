@@ -0,0 +1,60 @@
+"""Cache search results from solr, and the spelling corrections applied to them.
+
+Results are cached per normalized (q, m, page), and corrections per
+normalized (q, m). Every key includes the current index generation, which
+is bumped whenever the index changes. This invalidates all cached searches
+at once without having to find them. As a change only becomes searchable
+once solr commits it, SEARCH_CACHE_SECONDS should stay short.
+
+The generation is kept in redis, as the index is changed by celery workers
+while the results are cached by the web processes.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+
+from misirlou.helpers.shared_redis import get_redis
+
+_GENERATION_KEY = 'musiclibs_search_generation'
+
+
+def get_generation():
+    """Return the current index generation."""
+    return int(get_redis().get(_GENERATION_KEY) or 0)
+
+
+def bump_generation():
+    """Invalidate all cached searches (call whenever the index changes)."""
+    get_redis().incr(_GENERATION_KEY)
+
+
+def normalize(value):
+    """Collapse the whitespace of a query, so equivalent queries share a key."""
+    if not value:
+        return None
+    return " ".join(value.split())
+
+
+def get_results(q, m, page):
+    """Return the cached solr response of a search, or None."""
+    return cache.get(_make_key('results', q, m, page))
+
+
+def set_results(q, m, page, results):
+    cache.set(_make_key('results', q, m, page), results, timeout=settings.SEARCH_CACHE_SECONDS)
+
+
+def get_correction(q, m):
+    """Return the collation a query is known to be corrected to, or None."""
+    return cache.get(_make_key('correction', q, m))
+
+
+def set_correction(q, m, collation):
+    cache.set(_make_key('correction', q, m), collation, timeout=settings.SEARCH_CACHE_SECONDS)
+
+
+def _make_key(kind, q, m, *args):
+    parts = (settings.SOLR_SERVER, normalize(q), normalize(m)) + args
+    digest = hashlib.md5(repr(parts).encode('utf-8')).hexdigest()
+    return 'musiclibs_search_{}_{}_{}'.format(kind, get_generation(), digest)
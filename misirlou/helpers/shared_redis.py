@@ -0,0 +1,27 @@
+"""The redis connection shared by all processes of the site.
+
+Django's default cache is local to each process, so state which the web
+processes and celery workers must agree on (e.g., the search cache
+generation, or which manifest tests are scheduled) is kept in redis.
+"""
+import threading
+import redis
+
+from django.conf import settings
+
+_lock = threading.Lock()
+_redis = None
+
+
+def get_redis():
+    """Return the process-wide StrictRedis client.
+
+    Its connection pool reconnects by itself after a fork.
+    """
+    global _redis
+    with _lock:
+        if _redis is None:
+            _redis = redis.StrictRedis(host=settings.REDIS_HOST,
+                                       port=settings.REDIS_PORT,
+                                       db=settings.REDIS_SERVER)
+    return _redis
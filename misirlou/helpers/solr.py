@@ -0,0 +1,69 @@
+"""Process-wide registry of solr connections.
+
+Constructing a scorched.SolrInterface fetches the schema of its core over
+HTTP, so an interface is created once per core and process and then shared.
+Each interface keeps a pooled, keep-alive session. The registry is reset
+after a fork, so celery worker processes never share sockets with their
+parent.
+"""
+import os
+import threading
+import requests
+import scorched
+from requests.adapters import HTTPAdapter
+
+from django.conf import settings
+
+_lock = threading.Lock()
+_interfaces = {}
+_sessions = {}
+_pid = os.getpid()
+
+
+def get_solr_interface(url=None):
+    """Return the shared SolrInterface of a solr core.
+
+    :param url: Url of the core. Defaults to settings.SOLR_SERVER.
+    """
+    url = url if url else settings.SOLR_SERVER
+    with _lock:
+        _reset_after_fork()
+        interface = _interfaces.get(url)
+        if interface is None:
+            interface = scorched.SolrInterface(url)
+            _mount_pool(interface.conn.http_connection)
+            _interfaces[url] = interface
+    return interface
+
+
+def get_solr_session(url=None):
+    """Return a shared, pooled requests.Session for raw requests to a solr core.
+
+    Use this for request handlers scorched does not wrap. Unlike
+    get_solr_interface(), it never fetches the schema.
+
+    :param url: Url of the core. Defaults to settings.SOLR_SERVER.
+    """
+    url = url if url else settings.SOLR_SERVER
+    with _lock:
+        _reset_after_fork()
+        session = _sessions.get(url)
+        if session is None:
+            session = requests.Session()
+            _mount_pool(session)
+            _sessions[url] = session
+    return session
+
+
+def _mount_pool(session):
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.SOLR_POOL_MAXSIZE)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+
+def _reset_after_fork():
+    global _pid
+    if _pid != os.getpid():
+        _interfaces.clear()
+        _sessions.clear()
+        _pid = os.getpid()
@@ -2,46 +2,122 @@ import os
 import time
 import sys
 import csv
+import threading
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 
+import tqdm
+from django.conf import settings
 from django.core.management.base import BaseCommand
-from misirlou.tasks import import_single_manifest
+from django.db import connection
+from misirlou.tasks import run_import, make_import_result
 from misirlou.models import Manifest
 from misirlou.helpers.manifest_utils import get_basic_url
+from misirlou.helpers.manifest_utils.importer import get_importer
+from misirlou.helpers.manifest_utils.index_buffer import SolrIndexBuffer
 
 
 class Command(BaseCommand):
     """Command for importing from a file. Use it like:
 
-    manage.py bulk_import --delay=[seconds] [files to import[files]]
+    manage.py bulk_import --delay=[seconds] --workers=[n] [files to import[files]]
+
+    Lines are sharded by domain: each domain is imported sequentially by one
+    worker (waiting --delay between its requests), while up to --workers
+    domains are imported at once. The line numbers of successful imports
+    are recorded in a checkpoint file next to the input, so an interrupted
+    import resumes where it stopped when run again, and failed lines are
+    retried. The checkpoint is removed once every line has succeeded.
+    Progress is shown on stderr as each line is imported.
     """
     help = 'Import a list of urls saved in a file.'
 
     def add_arguments(self, parser):
-        parser.add_argument('-d', '--delay', type=float, default=0.3, help="Seconds to wait between requests.")
+        parser.add_argument('-d', '--delay', type=float, default=0.3, help="Seconds to wait between requests to a domain.")
+        parser.add_argument('-w', '--workers', type=int, default=4, help="Number of domains to import from concurrently.")
         parser.add_argument('--skip-indexed', dest='skip_indexed', action='store_true', help="Skip lines if they've already been imported.")
         parser.add_argument('--no-skip-indexed', dest='skip_indexed', action='store_false', help="Don't skip lines if they've already been imported.")
         parser.set_defaults(skip_indexed=True)
         parser.add_argument('file', nargs='*', help="File containing list of urls.")
 
     def handle(self, *args, **options):
+        self.writer = csv.writer(sys.stdout)
+        self.writer.writerow(('status', 'id', 'url', 'errors', 'warnings'))
+        self.lock = threading.Lock()
+        indexed = self.get_indexed_urls() if options['skip_indexed'] else set()
         for file in options['file']:
-            self.import_from_file(file, options['delay'], options['skip_indexed'])
+            self.import_from_file(file, options['delay'], options['workers'], indexed)
+
+    def get_indexed_urls(self):
+        """Get the basic urls of all indexed manifests in one query."""
+        urls = Manifest.objects.indexed().values_list('remote_url', flat=True)
+        return {get_basic_url(url) for url in urls.iterator()}
 
-    def import_from_file(self, path, delay, skip_indexed):
+    def import_from_file(self, path, delay, workers, indexed):
         """Import manifests from a newline delimited file of urls."""
         if not os.path.exists(path):
             print("{} is not reachable.".format(path))
             return
+
+        checkpoint_path = path + '.checkpoint'
+        completed = set()
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as f:
+                completed = {int(line) for line in f if line.strip()}
+
+        shards = {}
         with open(path) as f:
-            writer = csv.writer(sys.stdout)
-            writer.writerow(('status', 'id', 'url', 'errors', 'warnings'))
-            for line in f:
-                line = line.strip('\n')
-                if skip_indexed:
-                    basic_url = get_basic_url(line)
-                    if Manifest.objects.indexed().filter(remote_url__contains=basic_url):
-                        continue
-                res = import_single_manifest(None, line)
-                writer.writerow(res)
-                time.sleep(delay)
+            for line_no, line in enumerate(f):
+                line = line.strip()
+                if not line or line_no in completed or get_basic_url(line) in indexed:
+                    continue
+                domain = urllib.parse.urlparse(line).netloc
+                shards.setdefault(domain, []).append((line_no, line))
+
+        self.failed = 0
+        total = sum(len(lines) for lines in shards.values())
+        with open(checkpoint_path, 'a') as checkpoint, \
+                tqdm.tqdm(total=total, unit="manifests") as progress, \
+                ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self.import_shard, lines, delay, checkpoint, progress)
+                       for lines in shards.values()]
+            for future in futures:
+                future.result()
+        if self.failed:
+            print("{} lines failed and will be retried on the next run.".format(self.failed), file=sys.stderr)
+        else:
+            os.remove(checkpoint_path)
+
+    def import_shard(self, lines, delay, checkpoint, progress):
+        """Import the (line number, url) pairs of one domain in order."""
+        # Imports are only finished once their batch is indexed, so results
+        # are written each time the index buffer is flushed.
+        created = []
+
+        def write_results():
+            with self.lock:
+                for line_no, man, imp_success, errors in created:
+                    result = make_import_result(man, imp_success, errors)
+                    self.writer.writerow(result)
+                    if result.status == settings.SUCCESS:
+                        checkpoint.write("{}\n".format(line_no))
+                    else:
+                        self.failed += 1
+                sys.stdout.flush()
+                checkpoint.flush()
+            created.clear()
+
+        try:
+            with SolrIndexBuffer() as index_buffer:
+                for line_no, line in lines:
+                    man = get_importer(line)
+                    imp_success, errors = run_import(man, index_buffer=index_buffer)
+                    created.append((line_no, man, imp_success, errors))
+                    with self.lock:
+                        progress.update()
+                    if not len(index_buffer):
+                        write_results()
+                    time.sleep(delay)
+            write_results()
+        finally:
+            connection.close()
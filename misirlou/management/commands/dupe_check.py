@@ -1,28 +1,101 @@
-from misirlou.models import Manifest
-from collections import defaultdict
-import urllib.parse
-import tqdm
 from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from misirlou.models import Manifest
+from misirlou.helpers.manifest_utils import get_basic_url
+from misirlou.tasks import import_single_manifest
+
+# The netloc and path of remote_url, exactly as get_basic_url() computes them
+# with urlparse: the netloc runs up to the first '/', '?' or '#', the path up
+# to the first '?' or '#', and ';params' are cut from the last path segment.
+NORMALIZED_URL_SQL = r"""
+    COALESCE(
+        substring(remote_url from '^[A-Za-z][A-Za-z0-9+.-]*://([^/?#]*)')
+        || regexp_replace(substring(remote_url from '^[A-Za-z][A-Za-z0-9+.-]*://[^/?#]*([^?#]*)'),
+                          ';[^/]*$', ''),
+        remote_url)
+"""
+
+# Group manifests by their normalized url, oldest first, keeping only the
+# groups with duplicates.
+DUPES_SQL = """
+    SELECT array_agg(id::text ORDER BY created)
+    FROM {table}
+    GROUP BY {normalized_url}
+    HAVING count(*) > 1
+"""
+
+# Number of groups fetched from the server-side cursor at once.
+CURSOR_ITERSIZE = 2000
 
 
 class Command(BaseCommand):
     """Command for finding duplicate manifests in the database.
 
-    A list of duplicated manifests is returned.
+    The ids of each group of duplicated manifests are printed, oldest
+    first, as they are read from the database. With --merge, only the
+    oldest manifest of each group is kept.
 
-    manage.py dupe_check
+    manage.py dupe_check [--merge]
     """
     help = 'Check the database for duplicates.'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--merge', action='store_true', default=False,
+                            help="Keep the oldest manifest of each group and delete the others.")
+
     def handle(self, *args, **options):
-        print(find_dupes())
+        count = 0
+        for ids in iter_dupes():
+            print(" ".join(ids))
+            if options['merge']:
+                merge_dupes(ids)
+            count += 1
+        if options['merge']:
+            print("Merged {} groups of duplicates.".format(count))
 
 
-def find_dupes():
-    """Creates a list of lists of duplicated manifests."""
-    dupe_dict = defaultdict(list)
-    for m in tqdm.tqdm(Manifest.objects.all()):
-        parsed = urllib.parse.urlparse(m.remote_url)
-        netloc_and_path = "".join(parsed[1:3])
-        dupe_dict[netloc_and_path].append(m)
-    return [v for v in dupe_dict.values() if len(v) > 1]
+def iter_dupes():
+    """Yield the ids of each group of duplicated manifests, oldest first.
+
+    The grouping is done by the database and the groups are streamed
+    through a server-side cursor, so the table is never loaded. The
+    groups are read inside a transaction, which any merges join.
+    """
+    sql = DUPES_SQL.format(table=connection.ops.quote_name(Manifest._meta.db_table),
+                           normalized_url=NORMALIZED_URL_SQL)
+    with transaction.atomic():
+        connection.ensure_connection()
+        with connection.connection.cursor(name='dupe_check') as cursor:
+            cursor.itersize = CURSOR_ITERSIZE
+            cursor.execute(sql)
+            for row in cursor:
+                yield row[0]
+
+
+def merge_dupes(ids):
+    """Keep the first (oldest) manifest of ids and delete the others.
+
+    The solr documents of the deleted manifests are removed by the
+    post_delete receiver. The kept manifest takes the normalized url, and
+    an https url if any of its duplicates had one. It is queued for import
+    if it was not indexed itself.
+    """
+    with transaction.atomic():
+        dupes = list(Manifest.objects.filter(pk__in=ids))
+        dupes.sort(key=lambda m: ids.index(str(m.pk)))
+        if not dupes:
+            return
+        keep = dupes[0]
+        https_urls = [m.remote_url for m in dupes if m.remote_url.startswith('https')]
+        for m in dupes[1:]:
+            m.delete()
+        if https_urls and not keep.remote_url.startswith('https'):
+            keep.remote_url = https_urls[0]
+        keep.normalized_url = get_basic_url(keep.remote_url)
+        keep.save()
+
+    if not keep.indexed:
+        remote_url = keep.remote_url
+        transaction.on_commit(lambda: import_single_manifest.apply_async(
+            args=[None, remote_url], kwargs={'force': True}))
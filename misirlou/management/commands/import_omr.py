@@ -1,14 +1,19 @@
+import csv
+import itertools
 import tqdm
 import ujson as json
 import requests
-import csv
-import scorched
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
 
+from misirlou.helpers.solr import get_solr_session
+from misirlou.helpers.omr import pack_location
+
 UPLOAD_POLL_WAIT_SECS = 0.25
 UPLOAD_PROGRESS_STEP = 5
+UPLOAD_BATCH_SIZE = 5000
 
 
 class Command(BaseCommand):
@@ -21,6 +26,10 @@ class Command(BaseCommand):
         parser.add_argument("csv_path", nargs=1, help="CSV file containing OMR data.")
         parser.add_argument("-d", "--document", nargs=1, choices=("Salzinnes", "Liber"), required=True,
                             help="Which document-specific indexing rules to apply.")
+        parser.add_argument("--batch-size", type=int, default=UPLOAD_BATCH_SIZE,
+                            help="Number of rows posted to solr per request.")
+        parser.add_argument("--workers", type=int, default=1,
+                            help="Number of batches posted to solr concurrently.")
 
     def handle(self, *args, **options):
         path = options['csv_path'][0]
@@ -36,7 +45,8 @@ class Command(BaseCommand):
 
         # Salzinnes specific mapping
         label_map = make_label_map(seq, doc_rules)
-        upload_to_solr(path, pk, label_map, doc=doc_rules)
+        upload_to_solr(path, pk, label_map, doc=doc_rules,
+                       batch_size=options['batch_size'], workers=options['workers'])
 
 
 def make_label_map(canvas_list, document):
@@ -53,31 +63,60 @@ def make_label_map(canvas_list, document):
     return label_map
 
 
-def upload_to_solr(filename, document_id, label_map, doc="Liber"):
-    """Commit a CSV file to solr"""
-    solr_con = scorched.SolrInterface(settings.SOLR_OCR)
-    num_lines = sum(1 for line in open(filename))
+def upload_to_solr(filename, document_id, label_map, doc="Liber",
+                   batch_size=UPLOAD_BATCH_SIZE, workers=1):
+    """Commit a CSV file to solr.
+
+    Rows are read lazily and posted to the update handler in batches of
+    batch_size, with commitWithin instead of a commit per batch. Up to
+    `workers` batches are in flight at once; reading the file waits when
+    they are all busy, so memory use does not grow with the file.
+    """
+    session = get_solr_session(settings.SOLR_OCR)
+    update_url = "{}update?commitWithin={}".format(settings.SOLR_OCR, settings.SOLR_COMMIT_WITHIN_MS)
+
+    with open(filename, 'r') as f, ThreadPoolExecutor(max_workers=workers) as executor:
+        rows = tqdm.tqdm(iter_rows(f, document_id, label_map, doc), unit="rows")
+        in_flight = set()
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                break
+            if len(in_flight) >= workers:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            in_flight.add(executor.submit(post_batch, session, update_url, batch))
+        for future in in_flight:
+            future.result()
 
+    resp = session.get(settings.SOLR_OCR + "update?commit=true")
+    resp.raise_for_status()
+
+
+def iter_rows(f, document_id, label_map, doc="Liber"):
+    """Yield the solr documents for the rows of an OMR CSV file."""
     last_folio = None
     last_url = None
     page = 0
-    doc_lst = []
-    with open(filename, 'r') as f:
-        reader = csv.DictReader(f)
-        for row in tqdm.tqdm(reader, total=num_lines):
-            if row['folio'] != last_folio:
-                last_folio = row['folio']
-                if len(doc_lst) > 100000:
-                    solr_con.add(doc_lst)
-                    solr_con.commit()
-                    doc_lst = []
-                page += 1
-                last_url = label_map[last_folio]
-            row['document_id'] = document_id
-            row['image_url'] = last_url
-            row['pagen'] = last_folio if doc == "Liber" else page
-            # More salzinne specific commands.
-            del row['siglum_slug']
-            del row['folio']
-            del row['type']
-            doc_lst.append(row)
+    for row in csv.DictReader(f):
+        if row['folio'] != last_folio:
+            last_folio = row['folio']
+            page += 1
+            last_url = label_map[last_folio]
+        row['document_id'] = document_id
+        row['image_url'] = last_url
+        row['pagen'] = last_folio if doc == "Liber" else page
+        row['location'] = pack_location(row['location'])
+        # More salzinne specific commands.
+        del row['siglum_slug']
+        del row['folio']
+        del row['type']
+        yield row
+
+
+def post_batch(session, update_url, batch):
+    """Post a list of documents to a solr update handler."""
+    resp = session.post(update_url, data=json.dumps(batch),
+                        headers={"Content-Type": "application/json"})
+    resp.raise_for_status()
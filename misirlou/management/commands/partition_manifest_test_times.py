@@ -1,41 +1,35 @@
-import random
-import math
-from datetime import timedelta
-
 from django.core.management.base import BaseCommand
+from django.db import connection, transaction
 from django.utils import timezone
 
 from misirlou.models.manifest import Manifest
 
+# Every manifest is bucketed by a hash of its id in a single UPDATE.
+PARTITION_SQL = """
+    UPDATE {table}
+    SET last_tested = %s - ((hashtext(id::text) & 2147483647) %% %s) * interval '1 day'
+"""
+
 
 class Command (BaseCommand):
     """Partitions the 'last-tested' time of all the manifests over the last 14 days.
 
-     Shuffle the manifests and partition these shuffled manifests into 1 of the 14
-     days in the last two weeks, setting the last_tested time to this day.
+     Every manifest is put into 1 of the 14 days in the last two weeks by a hash
+     of its id, setting the last_tested time to this day.
 
      Idea is that if none of the manifests have been tested in a long time, you can
-     divide them up, then using `test_all_manifests -d 14`, we can test 1/14 of them each
-     day for the next two weeks. Thus avoiding testing all the manifests from one provider
-     on the same day."""
+     divide them up, so the sweep_manifest_tests beat task (or `test_all_manifests -d 14`
+     run daily, which queues 1/14 of them over each day) tests the overdue manifests
+     spread over the next two weeks. Thus avoiding testing all the manifests from one
+     provider on the same day.
+
+     The times are set with a bulk UPDATE, so no signals are sent and no tests
+     are queued."""
 
     _two_weeks_in_days = 14
 
     def handle(self, *args, **kwargs):
-        m = list(Manifest.objects.all())
-        random.shuffle(m)
-        partition_size = math.ceil(len(m) / self._two_weeks_in_days)
-
-        slice_left = 0
-        slice_right = partition_size
-        partitions = []
-        for day in range(self._two_weeks_in_days):
-            partitions.append(m[slice_left: slice_right])
-            slice_left += partition_size
-            slice_right += partition_size
-
-        for day in range(self._two_weeks_in_days):
-            target_date = timezone.now() - timedelta(day)
-            for manifest in partitions[day]:
-                manifest.last_tested = target_date
-                manifest.save()
+        now = timezone.now()
+        sql = PARTITION_SQL.format(table=connection.ops.quote_name(Manifest._meta.db_table))
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(sql, [now, self._two_weeks_in_days])
@@ -1,11 +1,79 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 from tqdm import tqdm
+from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.db import connection
 from misirlou.models.manifest import Manifest
+from misirlou.helpers import search_cache
+from misirlou.helpers.solr import get_solr_interface
+from misirlou.helpers.manifest_utils.importer import get_reindexer
+from misirlou.helpers.manifest_utils.index_buffer import SolrIndexBuffer
+
+# Number of stored manifests fetched from solr per cursor page.
+CHUNK_SIZE = 500
 
 
 class Command (BaseCommand):
-    """Reindex all indexed manifests locally."""
+    """Reindex all indexed manifests locally.
+
+    With --trusted, only the solr documents are rebuilt from the stored
+    manifests, which are not validated again. This is the way to apply a
+    change to the solr schema or to the indexed fields. The stored manifests
+    are paged through with a solr cursor, and the documents are indexed in
+    batches by --workers threads. The search cache is invalidated once, at
+    the end."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--trusted', action='store_true', default=False,
+                            help="Rebuild the solr documents from the stored manifests without revalidating them.")
+        parser.add_argument('-w', '--workers', type=int, default=1,
+                            help="Number of threads rebuilding documents with --trusted.")
+
+    def handle(self, *args, **options):
+        if not options['trusted']:
+            for manifest in Manifest.objects.indexed():
+                manifest.re_index_from_stored()
+            return
+
+        workers = max(options['workers'], 1)
+        total = Manifest.objects.indexed().count()
+        with tqdm(total=total) as progress, ThreadPoolExecutor(max_workers=workers) as executor:
+            # Keep only a few pages in memory ahead of the workers.
+            pending = deque()
+            for page in self.iter_stored_pages():
+                if len(pending) >= workers * 2:
+                    pending.popleft().result()
+                pending.append(executor.submit(self.reindex_trusted, page, progress))
+            for future in pending:
+                future.result()
+        search_cache.bump_generation()
+
+    def iter_stored_pages(self):
+        """Yield lists of (id, stored manifest) pairs of every solr document, by id."""
+        solr_conn = get_solr_interface(settings.SOLR_SERVER)
+        search = solr_conn.query().field_limit(['id', 'manifest']).sort_by('id')
+        page = []
+        for doc in search.cursor(rows=CHUNK_SIZE):
+            if 'manifest' not in doc:
+                continue
+            page.append((doc['id'], doc['manifest']))
+            if len(page) >= CHUNK_SIZE:
+                yield page
+                page = []
+        if page:
+            yield page
 
-    def handle(self, *args, **kwargs):
-        for manifest in Manifest.objects.indexed():
-            manifest.re_index_from_stored()
+    def reindex_trusted(self, page, progress):
+        """Reindex the manifests of a page, loading their rows in one query."""
+        stored = dict(page)
+        try:
+            with SolrIndexBuffer() as index_buffer:
+                for manifest in Manifest.objects.indexed().filter(pk__in=stored):
+                    importer = get_reindexer(manifest, text=stored[str(manifest.pk)])
+                    importer.bump_search_cache = False
+                    importer.reindex(index_buffer=index_buffer)
+                    progress.update()
+        finally:
+            connection.close()
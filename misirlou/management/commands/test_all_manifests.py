@@ -1,24 +1,29 @@
-import random
-
+from django.conf import settings
 from django.core.management.base import BaseCommand
 
-from misirlou.models import Manifest
-from misirlou.models.manifest import test_if_needed
+from misirlou.tasks import sweep_manifest_tests
 
 
 class Command (BaseCommand):
-    """Test all manifests that have not been tested in a certain timeframe."""
+    """Test the manifests that have not been tested in a certain timeframe.
+
+    Runs one sweep of the sweep_manifest_tests task, which celery beat
+    otherwise runs every TEST_SWEEP_PERIOD_SECONDS: tests for the share of
+    due manifests that fits in one period are queued, spread over that
+    period. The period defaults to one day, so running this command daily
+    tests every manifest once per --days days."""
 
-    help = 'Test all manifests in the database that have not recently been tested.'
+    _one_day_in_seconds = 86400
+
+    help = 'Queue tests for manifests in the database that have not recently been tested.'
 
     def add_arguments(self, parser):
-        parser.add_argument('-d', '--days', type=int, default=14, help='Number of days since last tested. That is, '
-                                                                       'manifests which have not been tested for this '
-                                                                       'many days will be targeted.')
+        parser.add_argument('-d', '--days', type=int, default=settings.TEST_INTERVAL_DAYS,
+                            help='Number of days since last tested. That is, manifests which have not been tested '
+                                 'for this many days will be targeted.')
+        parser.add_argument('-p', '--period', type=int, default=self._one_day_in_seconds,
+                            help='Seconds to spread the tests over, which should be the time until the next run.')
 
     def handle(self, *args, **options):
-        manifests = list(Manifest.objects.indexed())
-        random.shuffle(manifests)
-
-        for m in manifests:
-            test_if_needed(Manifest, m, days_since_last_test=options['days'])
+        queued = sweep_manifest_tests(days=options['days'], period=options['period'])
+        print("Queued {} manifest tests.".format(queued))
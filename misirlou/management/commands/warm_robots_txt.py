@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from misirlou.models import Source
+from misirlou.helpers.requester import DEFAULT_REQUESTER
+
+
+class Command(BaseCommand):
+    """Fetch the robots.txt of every known library into the shared registry.
+
+    Run this once per cluster (e.g., on deploy) so workers start with the
+    correct crawl delays without fetching robots.txt themselves.
+
+    manage.py warm_robots_txt
+    """
+    help = 'Cache the robots.txt crawl delay of every known library.'
+
+    def handle(self, *args, **options):
+        domains = set(Source.objects.values_list('iiif_hostname', flat=True))
+        for domain in sorted(filter(None, domains)):
+            delay = DEFAULT_REQUESTER.robots.refresh(domain)
+            print("{}: {}".format(domain, delay))
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('misirlou', '0014_auto_20160607_1345'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='manifest',
+            name='remote_etag',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='manifest',
+            name='remote_last_modified',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from urllib.parse import urlparse
+
+from django.db import migrations, models
+
+
+def set_normalized_urls(apps, schema_editor):
+    """Set normalized_url on the oldest manifest of every url.
+
+    Newer duplicates of a url are left without one, so the unique
+    constraint can be added. They are listed by dupe_check.
+    """
+    Manifest = apps.get_model('misirlou', 'Manifest')
+    seen = set()
+    rows = Manifest.objects.order_by('created').values_list('id', 'remote_url')
+    for pk, remote_url in rows.iterator():
+        parsed = urlparse(remote_url)
+        normalized = "".join(parsed[1:3])
+        if normalized in seen:
+            continue
+        seen.add(normalized)
+        Manifest.objects.filter(pk=pk).update(normalized_url=normalized)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('misirlou', '0015_manifest_remote_validators'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='manifest',
+            name='normalized_url',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.RunPython(set_normalized_urls, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='manifest',
+            name='normalized_url',
+            field=models.TextField(blank=True, null=True, unique=True),
+        ),
+    ]
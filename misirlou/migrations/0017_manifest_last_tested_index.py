@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('misirlou', '0016_manifest_normalized_url'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='manifest',
+            name='last_tested',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -1,13 +1,18 @@
 import uuid
+import hashlib
 import ujson as json
 
 from misirlou.helpers.manifest_utils.errors import ErrorMap
+from misirlou.helpers.manifest_utils.utils import get_basic_url
 from misirlou.signals import manifest_imported
+from misirlou.helpers.solr import get_solr_interface
+from misirlou.helpers import search_cache
+from misirlou.helpers.shared_redis import get_redis
 
-import scorched
 from collections.abc import Iterable
 from django.conf import settings
-from django.db import models, connection
+from django.core.cache import caches
+from django.db import models, connection, transaction
 from django.db.utils import OperationalError
 from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
@@ -42,7 +47,10 @@ class Manifest(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
     remote_url = models.TextField(unique=True)
+    normalized_url = models.TextField(unique=True, null=True, blank=True)  # Netloc and path of remote_url.
     manifest_hash = models.CharField(max_length=40, default="")  # An sha1 hash of the manifest.
+    remote_etag = models.CharField(max_length=255, blank=True, default="")  # ETag header of the last fetch.
+    remote_last_modified = models.CharField(max_length=64, blank=True, default="")  # Last-Modified header of the last fetch.
     indexed = models.BooleanField(default=False)
     objects = ManifestManager()
 
@@ -51,7 +59,7 @@ class Manifest(models.Model):
                                related_name="manifests", on_delete=models.SET_NULL)
 
     is_valid = models.BooleanField(default=False)
-    last_tested = models.DateTimeField(null=True, blank=True)
+    last_tested = models.DateTimeField(null=True, blank=True, db_index=True)
     _error = models.IntegerField(default=0)
     _warnings = models.CommaSeparatedIntegerField(null=True, blank=True, max_length=100)
 
@@ -81,6 +89,29 @@ class Manifest(models.Model):
             raise ValueError("Warnings must be an iterable of integers.")
         self._warnings = ",".join(str(int(i)) for i in iter)
 
+    def save(self, *args, **kwargs):
+        """Keep normalized_url in step with remote_url.
+
+        Rows left without a normalized_url are duplicates of an older
+        manifest (see dupe_check), and are kept that way.
+        """
+        if self._state.adding or self.normalized_url is not None:
+            self.normalized_url = get_basic_url(self.remote_url)
+        super().save(*args, **kwargs)
+
+    def conditional_headers(self):
+        """Headers for a conditional GET of the remote manifest.
+
+        A remote which has not changed since it was last fetched can answer
+        a request with these headers with '304 Not Modified'.
+        """
+        headers = {}
+        if self.remote_etag:
+            headers['If-None-Match'] = self.remote_etag
+        if self.remote_last_modified:
+            headers['If-Modified-Since'] = self.remote_last_modified
+        return headers
+
     def get_absolute_url(self):
         """Compute and return the url for this manifest with this host."""
         from django.core.urlresolvers import reverse
@@ -94,13 +125,39 @@ class Manifest(models.Model):
         """
         if not self.indexed:
             raise ValueError("Can't get stored manifest from non-indexed manifest. Use Manifest.objects.indexed().")
-        solr_con = scorched.SolrInterface(settings.SOLR_SERVER)
+        solr_con = get_solr_interface(settings.SOLR_SERVER)
         man = solr_con.query(id=str(self.id)).set_requesthandler('/manifest').execute()
         if to_json:
             return json.loads(man.result.docs[0]['manifest'])
         else:
             return man.result.docs[0]['manifest']
 
+    def get_cached_manifest(self):
+        """Retrieve the stored manifest as serialized JSON bytes, along with its ETag.
+
+        Reads through a cache keyed by id, manifest_hash and the time the row
+        was last saved, so the stored manifest is only fetched from solr when
+        it is not cached. Every import saves the row, so a re-imported
+        manifest gets a new key in every process instead of relying on an
+        eviction that a per-process cache would not share. The ETag is a
+        hash of the bytes themselves. Manifests larger than
+        MANIFEST_CACHE_MAX_BYTES are not cached, so the per-process
+        'manifests' cache stays bounded.
+
+        :return: Tuple of (JSON bytes, ETag string).
+        """
+        key = 'musiclibs_manifest_json_{}_{}_{}'.format(
+            self.id, self.manifest_hash, self.updated.strftime('%Y%m%d%H%M%S%f'))
+        manifest_cache = caches['manifests']
+        cached = manifest_cache.get(key)
+        if cached is None:
+            content = self.get_stored_manifest(to_json=False).encode('utf-8')
+            etag = '"{}"'.format(hashlib.sha1(content).hexdigest())
+            cached = (content, etag)
+            if len(content) <= settings.MANIFEST_CACHE_MAX_BYTES:
+                manifest_cache.set(key, cached, timeout=settings.MANIFEST_CACHE_SECONDS)
+        return cached
+
     def re_index(self, force=False, **kwargs):
         """Use the remote_url to retrieve a fresh copy (external) of this manifest and index it."""
         from misirlou.tasks import import_single_manifest
@@ -112,6 +169,11 @@ class Manifest(models.Model):
         man = self.get_stored_manifest(to_json=False)
         return import_single_manifest(man, self.remote_url, force=force)
 
+    def re_index_trusted(self, index_buffer=None):
+        """Rebuild only the solr document from the stored copy, without revalidating it."""
+        from misirlou.helpers.manifest_utils.importer import get_reindexer
+        return get_reindexer(self).reindex(index_buffer=index_buffer)
+
     def do_tests(self):
         """Run tests on the manifest and save any warnings or error it has."""
         if not self.indexed:
@@ -129,14 +191,14 @@ class Manifest(models.Model):
 
     def _update_solr_validation(self):
         """Update only the 'is_valid' key in the solr document representing this manifest."""
-        solr_conn = scorched.SolrInterface(settings.SOLR_SERVER)
+        solr_conn = get_solr_interface(settings.SOLR_SERVER)
         solr_conn.add({"id": str(self.id),
                        "is_valid": {"set": self.is_valid}})
 
     def set_thumbnail(self, index=None):
         """Set the thumbnail to an image from the sequence at given index."""
         man = self.get_stored_manifest()
-        solr_conn = scorched.SolrInterface(settings.SOLR_SERVER)
+        solr_conn = get_solr_interface(settings.SOLR_SERVER)
 
         if index is None:
             index = len(man['sequences'][0])//2
@@ -155,7 +217,7 @@ class Manifest(models.Model):
         """
         changes = {k: {"set": v} for k, v in kwargs.items()}
         changes["id"] = str(self.id)
-        solr_conn = scorched.SolrInterface(settings.SOLR_SERVER)
+        solr_conn = get_solr_interface(settings.SOLR_SERVER)
         solr_conn.add(changes)
 
     def auto_source(self):
@@ -181,13 +243,19 @@ def alert_importer(sender, id=None, local_url=None, **kwargs):
 
 @receiver(post_delete, sender=Manifest)
 def solr_delete(sender, instance, **kwargs):
-    solr_conn = scorched.SolrInterface(settings.SOLR_SERVER)
+    solr_conn = get_solr_interface(settings.SOLR_SERVER)
     solr_conn.delete_by_ids(str(instance.id))
+    search_cache.bump_generation()
 
 
 @receiver(post_save, sender=Manifest)
 def test_if_needed(sender, instance, days_since_last_test=7, **kwargs):
-    from misirlou.tasks import test_manifest
+    """Schedule a test of the manifest if it is due for one.
+
+    The test is only published once the saving transaction commits, so
+    rolled back rows are never tested. Saves of the same manifest within
+    TEST_SCHEDULE_DEDUP_SECONDS lead to one test, in every process.
+    """
     must_test = False
 
     if not instance.indexed:
@@ -200,4 +268,13 @@ def test_if_needed(sender, instance, days_since_last_test=7, **kwargs):
         if time_delta.days >= days_since_last_test:
             must_test = True
     if must_test:
-        test_manifest.apply_async(args=[str(instance.id)], countdown=60)
+        man_id = str(instance.id)
+        transaction.on_commit(lambda: schedule_test(man_id))
+
+
+def schedule_test(man_id):
+    """Publish a test of a manifest unless one was recently scheduled."""
+    from misirlou.tasks import test_manifest
+    key = 'musiclibs_manifest_test_scheduled_{}'.format(man_id)
+    if get_redis().set(key, 1, nx=True, ex=settings.TEST_SCHEDULE_DEDUP_SECONDS):
+        test_manifest.apply_async(args=[man_id], countdown=60)
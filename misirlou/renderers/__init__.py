@@ -1 +1,2 @@
 from .single_page_app_renderer import SinglePageAppRenderer
+from .raw_json_renderer import RawJSONRenderer
@@ -0,0 +1,13 @@
+from rest_framework.renderers import JSONRenderer
+
+
+class RawJSONRenderer (JSONRenderer):
+    """
+    JSON renderer which passes data that is already serialized (bytes)
+    through untouched, instead of parsing and re-dumping it
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, bytes):
+            return data
+        return super().render(data, accepted_media_type, renderer_context)
@@ -152,6 +152,67 @@ SOLR_SERVER = "http://localhost:8983/solr/{}/".format(SOLR_MAIN_CORE)
 SOLR_OCR_CORE = "musiclibs_ocr"
 SOLR_OCR = "http://localhost:8983/solr/{}/".format(SOLR_OCR_CORE)
 SOLR_TEST = "http://localhost:8983/solr/misirlou_test/"
+# Maximum number of kept-alive connections to each solr core per process.
+SOLR_POOL_MAXSIZE = 20
+# Number of documents the importer indexes in solr at once during bulk imports.
+SOLR_INDEX_BATCH_SIZE = 100
+# Seconds after which a partial batch of documents is indexed anyway.
+SOLR_INDEX_BATCH_SECONDS = 30
+# Milliseconds within which solr commits batch indexed documents.
+SOLR_COMMIT_WITHIN_MS = 10000
+# Seconds the serialized stored manifest served by ManifestDetail is cached.
+MANIFEST_CACHE_SECONDS = 604800
+# Serialized manifests larger than this many bytes are not cached.
+MANIFEST_CACHE_MAX_BYTES = 256 * 1024
+# Number of serialized manifests cached per process. With the size limit,
+# this bounds the memory the cache takes.
+MANIFEST_CACHE_MAX_ENTRIES = 200
+# Seconds search results and spelling corrections are cached.
+SEARCH_CACHE_SECONDS = 600
+
+# Serialized manifests get their own cache, so they can't crowd out search
+# results, and its size is bounded.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'manifests': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'manifests',
+        'TIMEOUT': MANIFEST_CACHE_SECONDS,
+        'OPTIONS': {'MAX_ENTRIES': MANIFEST_CACHE_MAX_ENTRIES},
+    },
+}
+
+# Importer settings
+# Number of threads used to fetch linked collections while crawling a collection.
+IMPORT_CRAWL_WORKERS = 8
+# Number of import tasks published at once when dispatching a collection.
+IMPORT_DISPATCH_CHUNK_SIZE = 200
+# Number of manifests of a collection imported (and indexed together) per task.
+IMPORT_BATCH_SIZE = 20
+
+# Tester settings
+# Manifests are retested once they have not been tested for this many days.
+TEST_INTERVAL_DAYS = 14
+# Seconds between runs of the sweep_manifest_tests periodic task. The tests
+# found by one run are spread over this period.
+TEST_SWEEP_PERIOD_SECONDS = 3600
+# A sweep tests at most this many times a source's share of its manifests
+# (its number of manifests * TEST_SWEEP_PERIOD_SECONDS / TEST_INTERVAL_DAYS).
+TEST_SWEEP_SOURCE_SHARE_FACTOR = 2
+# Seconds during which further saves of a manifest don't schedule another test.
+TEST_SCHEDULE_DEDUP_SECONDS = 600
+
+# Requester settings
+# Maximum number of kept-alive connections per remote domain.
+REQUESTER_POOL_MAXSIZE = 10
+# Seconds before an unused per-domain session is closed.
+REQUESTER_SESSION_IDLE_SECONDS = 300
+# User agent sent with requests and matched against robots.txt records.
+REQUESTER_USER_AGENT = "musiclibs"
+# Seconds a domain's robots.txt crawl delay is cached in redis.
+ROBOTS_TXT_CACHE_SECONDS = 86400
 
 # Metadata mappings
 reverse_map = {
@@ -210,6 +271,12 @@ CELERY_RESULT_SERIALIZER = 'json'
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_REDIS_MAX_CONNECTIONS = 1000
 CELERY_TIMEZONE = 'UTC'
+CELERYBEAT_SCHEDULE = {
+    'sweep-manifest-tests': {
+        'task': 'misirlou.tasks.sweep_manifest_tests',
+        'schedule': timedelta(seconds=TEST_SWEEP_PERIOD_SECONDS),
+    },
+}
 
 # Route celery settings for different configs.
 if SETTING_TYPE != LOCAL:
@@ -218,6 +285,7 @@ if SETTING_TYPE != LOCAL:
         "test": {'queue': 'musiclibs_test'}
     }
     CELERY_ROUTES = {'misirlou.tasks.import_single_manifest': CELERY_QUEUE_DICT['import'],
+                     'misirlou.tasks.import_manifest_batch': CELERY_QUEUE_DICT['import'],
                      'misirlou.tasks.test_manifest': CELERY_QUEUE_DICT['test']}
     CELERY_RESULT_BACKEND = 'redis://{}/{}'.format(REDIS_HOST, str(REDIS_SERVER))
 
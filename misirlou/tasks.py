@@ -2,12 +2,21 @@ from __future__ import absolute_import
 
 from celery import shared_task
 from celery import current_app
+from celery import group
+from celery.result import GroupResult
 from celery.signals import after_task_publish
 from django.conf import settings
-from collections import namedtuple
+from django.db.models import Count
+from django.utils import timezone
+from collections import namedtuple, defaultdict
+from datetime import timedelta
+import itertools
+import math
 
 from.models.manifest import Manifest
 from .helpers.manifest_utils.importer import get_importer
+from .helpers.manifest_utils.index_buffer import SolrIndexBuffer
+from .helpers.requester import DEFAULT_REQUESTER, get_domain
 
 # A named tuple for passing task-results from importing Manifests.
 ImportResult = namedtuple('ImportResult', ['status', 'id', 'url', 'errors', 'warnings'])
@@ -23,26 +32,106 @@ def import_single_manifest(man_data, remote_url, force=False):
     :return: ImportResult with all information about the result of this task.
     """
     man = get_importer(remote_url, prefetched_data=man_data)
-    errors = []
-    warnings = []
+    imp_success, errors = run_import(man, force=force)
+    return make_import_result(man, imp_success, errors)
 
+
+@shared_task
+def import_manifest_batch(remote_urls, force=False):
+    """Import a list of manifests, indexing them in solr in batches.
+
+    :param remote_urls: List of manifest urls.
+    :param force: Bool to force reimport (won't check if existing db rep is identical).
+    :return: List of ImportResults, in the same order as remote_urls.
+    """
+    created = []
+    with SolrIndexBuffer() as index_buffer:
+        for remote_url in remote_urls:
+            man = get_importer(remote_url)
+            imp_success, errors = run_import(man, force=force, index_buffer=index_buffer)
+            created.append((man, imp_success, errors))
+    return [make_import_result(man, imp_success, errors) for man, imp_success, errors in created]
+
+
+def run_import(man, force=False, index_buffer=None):
+    """Run man.create(), catching any exception it raises.
+
+    :return: Tuple of (success, list of errors raised).
+    """
     try:
-        imp_success = man.create(force=force)
+        return man.create(force=force, index_buffer=index_buffer), []
     except Exception as e:
-        imp_success = False
-        errors.append(str(e))
+        return False, [str(e)]
 
-    if imp_success:
-        warnings.extend(man.warnings)
+
+def make_import_result(man, imp_success, errors):
+    """Build the ImportResult of an importer after run_import().
+
+    The import is only a success if the importer's document was also
+    indexed, which for buffered imports is only known after a flush.
+    """
+    errors = list(errors)
+    warnings = list(man.warnings)
+    if imp_success and not man.index_failed:
         status = settings.SUCCESS
     else:
-        warnings.extend(man.warnings)
         errors.extend(man.errors)
         status = settings.ERROR
 
     return ImportResult(status, man.id, man.remote_url, errors, warnings)
 
 
+def dispatch_imports(urls, shared_id, chunk_size=None, batch_size=None):
+    """Publish batched import tasks as urls arrive, saved under one group id.
+
+    The urls of each host are grouped into import_manifest_batch tasks of
+    batch_size, so their solr documents are indexed together. Rather than
+    one global skew, every host gets its own schedule: a batch is delayed by
+    the crawl delays of all earlier manifests from its host, so collections
+    spread over many hosts are not held back by their size.
+
+    :param urls: Iterable of manifest urls (can be a generator).
+    :param shared_id: Id to save the resulting GroupResult under.
+    :param chunk_size: Number of tasks published per message batch.
+    :param batch_size: Number of manifests imported per task.
+    :return: The saved GroupResult, or None if there were no urls.
+    """
+    chunk_size = chunk_size if chunk_size else settings.IMPORT_DISPATCH_CHUNK_SIZE
+    batch_size = batch_size if batch_size else settings.IMPORT_BATCH_SIZE
+    next_countdown = {}
+    batches = {}
+    results = []
+    chunk = []
+
+    def add_batch(domain):
+        batch = batches.pop(domain)
+        countdown = next_countdown.get(domain, 0)
+        next_countdown[domain] = countdown + len(batch) * DEFAULT_REQUESTER.crawl_delay(domain)
+        chunk.append(import_manifest_batch.s(batch).set(countdown=countdown))
+        if len(chunk) >= chunk_size:
+            publish()
+
+    def publish():
+        results.extend(group(chunk).apply_async().results)
+        chunk.clear()
+
+    for url in urls:
+        domain = get_domain(url)
+        batches.setdefault(domain, []).append(url)
+        if len(batches[domain]) >= batch_size:
+            add_batch(domain)
+    for domain in list(batches):
+        add_batch(domain)
+    if chunk:
+        publish()
+
+    if not results:
+        return None
+    group_result = GroupResult(shared_id, results)
+    group_result.save()
+    return group_result
+
+
 @shared_task(ignore_results=True)
 def test_manifest(man_id):
     try:
@@ -53,6 +142,69 @@ def test_manifest(man_id):
     man.do_tests()
 
 
+@shared_task(ignore_results=True)
+def sweep_manifest_tests(days=None, period=None):
+    """Queue tests for a share of the manifests that are due for one.
+
+    Run every `period` seconds by celery beat. Each run tests just enough
+    manifests (least recently tested first) for every indexed manifest to
+    be tested once every `days` days, so the test load stays flat. Each
+    source gets the same share of its own manifests, up to
+    TEST_SWEEP_SOURCE_SHARE_FACTOR times over to catch up, and the tests are
+    spread over the period with sources interleaved. The last_tested time
+    of the queued manifests is set as they are queued, so the next run
+    does not queue them again while their tests are pending.
+
+    :return: Number of tests queued.
+    """
+    days = days if days else settings.TEST_INTERVAL_DAYS
+    period = period if period else settings.TEST_SWEEP_PERIOD_SECONDS
+    share = period / (days * 86400)
+    source_counts = dict(Manifest.objects.indexed().order_by().values_list('source_id')
+                         .annotate(count=Count('id')))
+    budget = math.ceil(sum(source_counts.values()) * share)
+    max_per_source = {source_id: math.ceil(count * share * settings.TEST_SWEEP_SOURCE_SHARE_FACTOR)
+                      for source_id, count in source_counts.items()}
+    by_source = select_due_manifests(days, budget, max_per_source)
+
+    # Interleave sources so no library gets its tests all at once.
+    ids = [pk for row in itertools.zip_longest(*by_source.values()) for pk in row if pk]
+    chunk_size = settings.IMPORT_DISPATCH_CHUNK_SIZE
+    for start in range(0, len(ids), chunk_size):
+        chunk = ids[start:start + chunk_size]
+        Manifest.objects.filter(pk__in=chunk).update(last_tested=timezone.now())
+        group(test_manifest.s(pk).set(countdown=int(i * period / len(ids)))
+              for i, pk in enumerate(chunk, start)).apply_async()
+    return len(ids)
+
+
+def select_due_manifests(days, budget, max_per_source):
+    """Select up to budget manifests not tested in the last `days` days.
+
+    Never tested manifests come first, then the least recently tested.
+
+    :param max_per_source: Dict of source id to the most manifests of that
+        source to select.
+
+    :return: Dict of source id to list of manifest ids.
+    """
+    cutoff = timezone.now() - timedelta(days=days)
+    indexed = Manifest.objects.indexed()
+    querysets = (indexed.filter(last_tested__isnull=True).order_by(),
+                 indexed.filter(last_tested__lt=cutoff).order_by('last_tested'))
+    by_source = defaultdict(list)
+    count = 0
+    for qs in querysets:
+        for pk, source_id in qs.values_list('id', 'source_id').iterator():
+            if count >= budget:
+                return by_source
+            ids = by_source[source_id]
+            if len(ids) < max_per_source.get(source_id, 0):
+                ids.append(str(pk))
+                count += 1
+    return by_source
+
+
 @after_task_publish.connect
 def update_sent_state(sender=None, body=None, **kwargs):
     # Change task.status to 'SENT' for all tasks which are sent in.
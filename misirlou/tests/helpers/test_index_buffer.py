@@ -0,0 +1,51 @@
+from unittest import mock
+
+import scorched
+from django.conf import settings
+
+from misirlou.helpers.manifest_utils.index_buffer import SolrIndexBuffer
+from misirlou.tasks import make_import_result
+from misirlou.tests.mis_test import MisirlouTestSetup
+
+
+class StubImporter:
+    """Importer whose document was built, recording how its import ended."""
+
+    def __init__(self, n, fail_to_record=False):
+        self.id = str(n)
+        self.remote_url = "http://example.com/{}/manifest.json".format(n)
+        self.doc = {'id': self.id}
+        self.warnings = []
+        self.errors = []
+        self.index_failed = False
+        self.finished = False
+        self.fail_to_record = fail_to_record
+
+    def _finish_import(self):
+        self.finished = True
+        return True
+
+    def _index_failed(self):
+        if self.fail_to_record:
+            # e.g., the solr validation update of an indexed manifest.
+            raise scorched.exc.SolrError("Solr is down.")
+        self.index_failed = True
+        self.errors.append("Failed to index.")
+        return False
+
+
+class SolrIndexBufferTestCase(MisirlouTestSetup):
+
+    def test_solr_add_fails(self):
+        """Every importer is failed on its own when solr rejects its document."""
+        importers = [StubImporter(n, fail_to_record=n % 2) for n in range(4)]
+        with mock.patch.object(SolrIndexBuffer, '_add', side_effect=scorched.exc.SolrError("Solr is down.")):
+            with SolrIndexBuffer(max_docs=10) as index_buffer:
+                for imp in importers:
+                    index_buffer.add(imp)
+
+        for imp in importers:
+            result = make_import_result(imp, True, [])
+            self.assertEqual(result.status, settings.ERROR, imp.id)
+            self.assertTrue(imp.errors, imp.id)
+            self.assertFalse(imp.finished, imp.id)
@@ -0,0 +1,21 @@
+from misirlou.helpers.omr import pack_location, unpack_location, add_regions
+from misirlou.tests.mis_test import MisirlouTestSetup
+
+
+class OMRLocationTestCase(MisirlouTestSetup):
+    legacy = "[{'ulx': 10, 'uly': 20, 'width': 30, 'height': 40}, {'ulx': 1, 'uly': 2, 'width': 3, 'height': 4}]"
+
+    def test_pack_legacy(self):
+        self.assertEqual(pack_location(self.legacy), "10,20,30,40;1,2,3,4")
+        self.assertEqual(pack_location("10,20,30,40"), "10,20,30,40")
+
+    def test_unpack_both_forms(self):
+        """Packed and legacy locations give the same boxes."""
+        boxes = [(10, 20, 30, 40), (1, 2, 3, 4)]
+        self.assertEqual(unpack_location(self.legacy), boxes)
+        self.assertEqual(unpack_location("10,20,30,40;1,2,3,4"), boxes)
+
+    def test_add_regions(self):
+        docs = add_regions([{'location': "10,20,30,40", 'image_url': "http://a.b/iiif/c"}])
+        self.assertEqual(docs[0]['location'], [{'ulx': 10, 'uly': 20, 'width': 30, 'height': 40}])
+        self.assertEqual(docs[0]['easy_url'], ["http://a.b/iiif/c/10,20,30,40/full/0/default.jpg"])
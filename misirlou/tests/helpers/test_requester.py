@@ -0,0 +1,34 @@
+from misirlou.helpers.requester import parse_crawl_delay
+from misirlou.tests.mis_test import MisirlouTestSetup
+
+
+class RobotsTxtTestCase(MisirlouTestSetup):
+    def test_default_record(self):
+        """The '*' record applies when no record names our user agent."""
+        robots = "User-agent: *\nDisallow: /private\nCrawl-delay: 5\n"
+        self.assertEqual(parse_crawl_delay(robots, "musiclibs"), 5)
+
+    def test_specific_record(self):
+        """A record naming our user agent takes precedence over '*'."""
+        robots = ("User-agent: *\nCrawl-delay: 10\n\n"
+                  "User-agent: otherbot\nUser-agent: MusicLibs\nCrawl-delay: 2.5\n")
+        self.assertEqual(parse_crawl_delay(robots, "musiclibs"), 2.5)
+
+    def test_other_records_ignored(self):
+        """Delays for other user agents are not applied to us."""
+        robots = ("User-agent: otherbot\nCrawl-delay: 20\n\n"
+                  "User-agent: *\nDisallow:\n")
+        self.assertIsNone(parse_crawl_delay(robots, "musiclibs"))
+
+    def test_comments_and_bad_values(self):
+        robots = "# Be nice.\nUser-agent: * # everyone\nCrawl-delay: soon\nCrawl-delay: 3 # seconds\n"
+        self.assertEqual(parse_crawl_delay(robots, "musiclibs"), 3)
+
+    def test_token_match(self):
+        """Records match our product token exactly, not substrings of it."""
+        robots = ("User-agent: music\nCrawl-delay: 20\n\n"
+                  "User-agent: m\nCrawl-delay: 15\n\n"
+                  "User-agent: *\nCrawl-delay: 1\n")
+        self.assertEqual(parse_crawl_delay(robots, "musiclibs"), 1)
+        robots = "User-agent: MusicLibs/2.0\nCrawl-delay: 4\n"
+        self.assertEqual(parse_crawl_delay(robots, "musiclibs/1.0"), 4)
@@ -0,0 +1,46 @@
+import ujson as json
+
+from misirlou.helpers.manifest_utils.scanner import scan_manifest, ManifestScanError
+from misirlou.tests.mis_test import MisirlouTestSetup
+
+
+class ManifestScannerTestCase(MisirlouTestSetup):
+    manifest = {
+        "@id": "http://example.com/manifest.json",
+        "label": "A label with \"quotes\", } and ]",
+        "metadata": [{"label": "Date", "value": ["1500", {"@value": "c. 1500"}]}],
+        "structures": [{"canvases": ["c0"]}],
+        "sequences": [{"@type": "sc:Sequence",
+                       "canvases": [{"@id": "c{}".format(i), "height": i} for i in range(5)]}]
+    }
+
+    def scan(self, fields, min_length=0):
+        return scan_manifest(json.dumps(self.manifest), fields, min_length=min_length)
+
+    def test_fields(self):
+        """Only the requested top-level fields are parsed."""
+        result = self.scan(("@id", "label", "metadata", "missing"))
+        self.assertEqual(result["label"], self.manifest["label"])
+        self.assertEqual(result["metadata"], self.manifest["metadata"])
+        self.assertNotIn("structures", result)
+        self.assertNotIn("missing", result)
+
+    def test_canvases(self):
+        """Canvases of the first sequence are parsed one at a time."""
+        canvases = self.scan(("@id",))["sequences"][0]["canvases"]
+        self.assertEqual(len(canvases), 5)
+        self.assertEqual(canvases[2], {"@id": "c2", "height": 2})
+
+    def test_parsed_when_short(self):
+        """Short manifests are parsed whole, with the same result."""
+        fields = ("@id", "label", "metadata", "missing")
+        scanned = self.scan(fields)
+        parsed = self.scan(fields, min_length=len(json.dumps(self.manifest)) + 1)
+        self.assertEqual(sorted(parsed), sorted(scanned))
+        self.assertEqual(list(parsed["sequences"][0]["canvases"]),
+                         [scanned["sequences"][0]["canvases"][i] for i in range(5)])
+
+    def test_malformed(self):
+        for min_length in (0, 1000):
+            with self.assertRaises(ManifestScanError):
+                scan_manifest('{"@id": "x", "sequences": [{"canvases": [', ("@id",), min_length=min_length)
@@ -0,0 +1,36 @@
+from django.utils.html import strip_tags
+
+from misirlou.helpers.manifest_utils.utils import strip_html
+from misirlou.tests.mis_test import MisirlouTestSetup
+
+
+class StripHtmlTestCase(MisirlouTestSetup):
+    samples = [
+        "No markup at all.",
+        "a < b and c > d",
+        "Tom &amp; <span class='q'>Jerry</span>",
+        '<p>Hello <a href="x>y">world</a></p>',
+        "<!-- comment --><!DOCTYPE html><i>text</i>",
+        "<<b>b>",
+        "x<br/>y",
+        "<p>unterminated <b",
+        "< p>not a tag</p>",
+        "<script>if (a<b) x;</script>",
+        "</ p>z",
+        "a</>b>",
+        "<1>x</1>",
+        "<b>" + "long " * 300 + "</b>",
+    ]
+
+    def test_matches_strip_tags(self):
+        for sample in self.samples:
+            self.assertEqual(strip_html(sample), strip_tags(sample), sample)
+
+    def test_long_value_cached(self):
+        value = "<p>" + "long description " * 100 + "</p>"
+        self.assertEqual(strip_html(value), strip_tags(value))
+        self.assertEqual(strip_html(value), strip_tags(value))
+
+    def test_plain_string_unchanged(self):
+        value = "Plain & simple"
+        self.assertIs(strip_html(value), value)
@@ -1,6 +1,10 @@
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from urllib import parse
 import ujson as json
-import requests
 
 from rest_framework.response import Response
 from rest_framework.renderers import JSONRenderer, BrowsableAPIRenderer
@@ -11,6 +15,35 @@ from rest_framework.reverse import reverse
 
 from misirlou.renderers import SinglePageAppRenderer
 from misirlou.models import Manifest, Source
+from misirlou.helpers.solr import get_solr_session
+from misirlou.helpers import search_cache
+from misirlou.helpers.omr import add_regions
+
+# Number of documents whose OMR regions are grouped in one request to the OCR core.
+MUSIC_SEARCH_CHUNK_SIZE = 5
+
+# Threads used to request the OMR regions of a page of documents concurrently.
+MUSIC_SEARCH_WORKERS = 4
+
+logger = logging.getLogger(__name__)
+
+_region_pool = None
+_region_pool_pid = None
+_region_pool_lock = threading.Lock()
+
+
+def get_region_pool():
+    """Return this process's thread pool for OMR region requests.
+
+    The pool is created lazily, and again after a fork, as the threads of
+    a parent process do not exist in its children.
+    """
+    global _region_pool, _region_pool_pid
+    with _region_pool_lock:
+        if _region_pool is None or _region_pool_pid != os.getpid():
+            _region_pool = ThreadPoolExecutor(max_workers=MUSIC_SEARCH_WORKERS)
+            _region_pool_pid = os.getpid()
+        return _region_pool
 
 
 class RootView(generics.GenericAPIView):
@@ -18,18 +51,35 @@ class RootView(generics.GenericAPIView):
                         BrowsableAPIRenderer)
 
     def get(self, request, *args, **kwargs):
-        results = do_search(request)
-
-        if should_redo_search(results):
-            collation = results['spellcheck']['collationQuery']
-            results = do_search(request, q=collation)
-            results['applied_correction'] = [request.GET.get('q'), collation]
+        q = request.GET.get('q')
+        m = request.GET.get('m')
+        timing = {}
+
+        # A query we already know to be misspelled goes straight to its correction.
+        collation = search_cache.get_correction(q, m) if q else None
+        if collation:
+            results = do_search(request, q=collation, timing=timing)
+            results['applied_correction'] = [q, collation]
+        else:
+            results = do_search(request, timing=timing)
+
+            if should_redo_search(results):
+                collation = results['spellcheck']['collationQuery']
+                search_cache.set_correction(q, m, collation)
+                results = do_search(request, q=collation, timing=timing)
+                results['applied_correction'] = [q, collation]
 
         resp = {
             'routes': {'manifests': reverse('manifest-list', request=request)},
             'search': results
         }
-        return Response(resp)
+        headers = {}
+        if timing:
+            logger.info("Music search q=%r m=%r: %s", q, m,
+                        ", ".join("{} {:.3f}s".format(k, v) for k, v in sorted(timing.items())))
+            headers['Server-Timing'] = ", ".join(
+                "{};dur={:.1f}".format(k, v * 1000) for k, v in sorted(timing.items()))
+        return Response(resp, headers=headers)
 
 
 class StatsView(generics.GenericAPIView):
@@ -52,7 +102,12 @@ class StatsView(generics.GenericAPIView):
         return Response({"manifests": manifest_count, "attributions": library_count})
 
 
-def do_search(request, q=None, m=None):
+def do_search(request, q=None, m=None, timing=None):
+    """Search solr, through the search cache.
+
+    :param timing: Dict to add the seconds spent in each stage of an
+        uncached music search to.
+    """
     q = q if q else request.GET.get('q')
     m = m if m else request.GET.get('m')
     page = request.GET.get('page')
@@ -61,15 +116,19 @@ def do_search(request, q=None, m=None):
     else:
         start = 0
 
-    if q and m:
-        res = do_music_join_search(q, m, start)
-    elif m and not q:
-        res = do_music_join_search("*:*", m, start)
-    elif q and not m:
-        res = do_minimal_search(q, start)
-    else:
+    if not q and not m:
         return None
 
+    res = search_cache.get_results(q, m, start)
+    if res is None:
+        if q and m:
+            res = do_music_join_search(q, m, start, timing)
+        elif m and not q:
+            res = do_music_join_search("*:*", m, start, timing)
+        else:
+            res = do_minimal_search(q, start)
+        search_cache.set_results(q, m, start, res)
+
     return format_response(request, res)
 
 
@@ -79,50 +138,66 @@ def do_minimal_search(q, start):
     uri.append("?q={}".format(q))
     uri.append("&start={}".format(start))
     uri = "".join(uri)
-    res = requests.get(uri)
+    res = get_solr_session(settings.SOLR_SERVER).get(uri)
     return res.json()
 
 
-def do_music_join_search(q, m, start):
-    """Get the documents which contain both the metadata and pitch strings."""
+def do_music_join_search(q, m, start, timing=None):
+    """Get the documents which contain both the metadata and pitch strings.
+
+    The search runs in two stages: a join query on the main core finds the
+    page of documents, then the regions where the pitch string occurs in
+    those documents are grouped on the OCR core. The second stage is split
+    into chunks of documents which are requested concurrently.
+
+    The seconds spent in each stage are added to the timing dict, if given.
+    They are kept out of the response, which is cached.
+    """
+    timing = timing if timing is not None else {}
 
     # Get the metadata of documents which match pitch string query.
+    stage_start = time.time()
     uri = [settings.SOLR_SERVER]
     uri.append('minimal?fq={!join from=document_id to=id fromIndex=%s}pnames:' % settings.SOLR_OCR_CORE)
     uri.append(m)
     uri.append('&q={}'.format(q))
-    uri = ''.join(uri)
-    resp = requests.get(uri).json()
-
-    # Find up to 4 regions where this pitch string occurs in each doc.
-    ids = ",".join([doc['id'] for doc in resp['response']['docs']])
-    fq = "{!terms f=document_id}" + ids
-    uri = [settings.SOLR_OCR]
-    uri.append('regions?q={}&fq={}'.format(m, fq))
-    uri.append('&group=on&group.field=document_id&group.sort=pagen asc&group.limit=4')
     uri.append('&start={}'.format(start))
     uri = ''.join(uri)
-    ocr_info = requests.get(uri).json()['grouped']['document_id']['groups']
-    ocr_info = {doc['groupValue']: add_easy_url(doc['doclist']['docs']) for doc in ocr_info}
+    resp = get_solr_session(settings.SOLR_SERVER).get(uri).json()
+    timing['join'] = time.time() - stage_start
 
-    # Combine the results into the scorched response
+    # Find up to 4 regions where this pitch string occurs in each doc.
+    stage_start = time.time()
+    ids = [doc['id'] for doc in resp['response']['docs']]
+    chunks = [ids[i:i + MUSIC_SEARCH_CHUNK_SIZE] for i in range(0, len(ids), MUSIC_SEARCH_CHUNK_SIZE)]
+    ocr_info = {}
+    for groups in get_region_pool().map(lambda chunk: get_omr_regions(m, chunk), chunks):
+        ocr_info.update(groups)
+    timing['regions'] = time.time() - stage_start
+
+    # Combine the results into the scorched response. Documents without
+    # regions (e.g., if the OCR core changed in between) get none.
     for doc in resp['response']['docs']:
-        doc['omr_hits'] = ocr_info[doc['id']]
+        doc['omr_hits'] = ocr_info.get(doc['id'], [])
 
     return resp
 
 
-def add_easy_url(ocr_info):
-    """Add an 'easy' url to look at the region in the ocr info dict."""
-    for doc in ocr_info:
-        loc = json.loads(doc['location'].replace("'", '"'))
-        doc['location'] = loc
-        easy_url = []
-        for l in loc:
-            easy_url.append(doc['image_url'] +\
-                            "/{},{},{},{}/full/0/default.jpg".format(l['ulx'], l['uly'], l['width'], l['height']))
-        doc['easy_url'] = easy_url
-    return ocr_info
+def get_omr_regions(m, ids):
+    """Get up to 4 regions where pitch string m occurs in each of the documents.
+
+    :return: Dict of document id to list of regions.
+    """
+    if not ids:
+        return {}
+    fq = "{!terms f=document_id}" + ",".join(ids)
+    uri = [settings.SOLR_OCR]
+    uri.append('regions?q={}&fq={}'.format(m, fq))
+    uri.append('&group=on&group.field=document_id&group.sort=pagen asc&group.limit=4')
+    uri.append('&rows={}'.format(len(ids)))
+    uri = ''.join(uri)
+    ocr_info = get_solr_session(settings.SOLR_OCR).get(uri).json()['grouped']['document_id']['groups']
+    return {doc['groupValue']: add_regions(doc['doclist']['docs']) for doc in ocr_info}
 
 
 def should_redo_search(results):
@@ -1,6 +1,5 @@
 import uuid
 import ujson as json
-import scorched
 import requests
 
 from rest_framework import generics
@@ -10,32 +9,47 @@ from rest_framework import status
 from rest_framework.reverse import reverse
 from rest_framework.permissions import IsAuthenticatedOrReadOnly, IsAuthenticated
 
-from misirlou.renderers import SinglePageAppRenderer
+from misirlou.renderers import SinglePageAppRenderer, RawJSONRenderer
 from misirlou.models import Manifest
 from misirlou.serializers import ManifestSerializer
 from misirlou.views import format_response
 from django.conf import settings
+from django.core.exceptions import ValidationError
 from misirlou.helpers.manifest_utils.importer import ManifestPreImporter
+from misirlou.helpers.solr import get_solr_interface
+from misirlou.helpers.omr import add_regions
 from celery import group
-from misirlou.tasks import import_single_manifest
+from misirlou.tasks import import_single_manifest, dispatch_imports
 
 RECENT_MANIFEST_COUNT = 12
 
 
 class ManifestDetail(generics.GenericAPIView):
-    renderer_classes = (SinglePageAppRenderer, JSONRenderer)
+    renderer_classes = (SinglePageAppRenderer, RawJSONRenderer)
 
     def get(self, request, *args, **kwargs):
+        """Return the stored manifest.
+
+        JSON responses are served straight from the cached serialized
+        manifest, and carry an ETag so clients can revalidate with a
+        conditional request.
+        """
         man_pk = self.kwargs['pk']
-        solr_conn = scorched.SolrInterface(settings.SOLR_SERVER)
-        response = solr_conn.query(man_pk).set_requesthandler('/manifest').execute()
-        if response.result.numFound != 1:
+        try:
+            manifest = Manifest.objects.indexed().get(pk=man_pk)
+            content, etag = manifest.get_cached_manifest()
+        except (Manifest.DoesNotExist, ValidationError, ValueError, IndexError):
             data = {
                 "error": "Could not resolve manifest '{}'".format(man_pk),
-                "numFound": response.result.numFound}
+                "numFound": 0}
             return Response(data, status=status.HTTP_400_BAD_REQUEST)
-        data = json.loads(response.result.docs[0]['manifest'])
-        return Response(data)
+
+        if request.accepted_renderer.format != 'json':
+            return Response(json.loads(content))
+
+        if etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+        return Response(content, headers={'ETag': etag})
 
 
 class ManifestDetailSearch(generics.GenericAPIView):
@@ -47,14 +61,11 @@ class ManifestDetailSearch(generics.GenericAPIView):
         music = request.GET.get("m")
         page = request.GET.get('p')
 
-        solr_conn = scorched.SolrInterface(settings.SOLR_OCR)
+        solr_conn = get_solr_interface(settings.SOLR_OCR)
         response = solr_conn.query(pnames=music, pagen=page).paginate(start=0, rows=100)\
             .filter(document_id=man_pk)\
             .field_limit(("neumes", "intervals", "location", "semitones")).execute()
-        for doc in response.result.docs:
-            doc['location'] = json.loads(doc['location'].replace("'", '"'))
-
-        return Response((doc for doc in response.result.docs))
+        return Response(add_regions(response.result.docs, with_url=False))
 
 
 class ManifestList(generics.ListCreateAPIView):
@@ -75,17 +86,16 @@ class ManifestList(generics.ListCreateAPIView):
 
         shared_id = str(uuid.uuid4())
         imp = ManifestPreImporter(remote_url)
-        lst = imp.get_all_urls()
-
-        # If there are manifests to import, create a celery group for the task.
-        if lst:
-            if len(lst) == 1:
-                g = group([import_single_manifest.s(imp.text, lst[0])])
-            else:
-                g = group([import_single_manifest.s(None, url) for url in lst]).skew(start=0, step=0.3)
-            task = g.apply_async(task_id=shared_id)
+
+        # A single manifest is imported with the data we already fetched. The
+        # manifests of a collection are dispatched in chunks as they are found.
+        if imp.type == "sc:Manifest" and not imp.errors:
+            task = group([import_single_manifest.s(imp.text, remote_url)]).apply_async(task_id=shared_id)
             task.save()
         else:
+            task = dispatch_imports(imp.iter_urls(), shared_id)
+
+        if not task:
             if imp.errors:
                 return Response({'errors': imp.errors}, status=status.HTTP_400_BAD_REQUEST)
             return Response({'errors': ['Failed to find recognisable IIIF manifest data.']}, status=status.HTTP_400_BAD_REQUEST)
@@ -27,9 +27,17 @@ class StatusView(generics.GenericAPIView):
             succeeded_count = 0
 
             if group_result.supports_native_join:
-                results = group_result.join_native()
+                task_results = group_result.join_native()
             else:
-                results = group_result.join()
+                task_results = group_result.join()
+
+            # Batch imports return a list of results, single imports one.
+            results = []
+            for res in task_results:
+                if res and isinstance(res[0], (list, tuple)):
+                    results.extend(res)
+                else:
+                    results.append(res)
 
             for res in results:
                 task_stat, man_id, rem_url, errors, warnings = res
@@ -43,6 +51,6 @@ class StatusView(generics.GenericAPIView):
 
             d = {'succeeded': succeeded, 'succeeded_count': succeeded_count,
                  'failed': failed, 'failed_count': failed_count,
-                 'total_count': len(group_result), 'status': settings.SUCCESS}
+                 'total_count': len(results), 'status': settings.SUCCESS}
 
             return Response(d)
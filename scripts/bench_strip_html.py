@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""Compare strip_html with django's strip_tags on the strings of manifests.
+
+Every string of the given manifest files (by default the test fixtures) is
+stripped with both functions, as ManifestImporter._remove_html would, and
+the results are checked to be identical. manifest.json has no html at all,
+while html_manifest.json has html descriptions of about 10 KB, repeated on
+some of its canvases.
+
+    python scripts/bench_strip_html.py [manifest.json ...] [-n repeats]
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "misirlou.settings")
+
+from django.utils.html import strip_tags
+from misirlou.helpers.manifest_utils import utils
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'misirlou', 'tests', 'fixtures')
+DEFAULT_MANIFESTS = [os.path.join(FIXTURES, 'manifest.json'), os.path.join(FIXTURES, 'html_manifest.json')]
+
+
+def iter_strings(obj):
+    if isinstance(obj, str):
+        yield obj
+    elif isinstance(obj, list):
+        for v in obj:
+            yield from iter_strings(v)
+    elif isinstance(obj, dict):
+        for k, v in obj.items():
+            yield k
+            yield from iter_strings(v)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('manifests', nargs='*', default=DEFAULT_MANIFESTS)
+    parser.add_argument('-n', '--number', type=int, default=10, help="Times each manifest is stripped.")
+    args = parser.parse_args()
+
+    for path in args.manifests:
+        with open(path) as f:
+            strings = list(iter_strings(json.load(f)))
+        for s in strings:
+            if strip_tags(s) != utils.strip_html(s):
+                print("Mismatch on {!r}".format(s))
+
+        def run_uncached():
+            utils._cached_strip_tags.cache_clear()
+            utils._long_cache.clear()
+            for s in strings:
+                utils.strip_html(s)
+
+        old = timeit.timeit(lambda: [strip_tags(s) for s in strings], number=args.number)
+        new = timeit.timeit(run_uncached, number=args.number)
+        cached = timeit.timeit(lambda: [utils.strip_html(s) for s in strings], number=args.number)
+        print("{}: {} strings".format(os.path.basename(path), len(strings)))
+        print("  strip_tags:          {:.4f}s".format(old))
+        print("  strip_html:          {:.4f}s ({:.1f}x)".format(new, old / new))
+        print("  strip_html (cached): {:.4f}s ({:.1f}x)".format(cached, old / cached))
+
+
+if __name__ == "__main__":
+    main()
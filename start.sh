@@ -35,4 +35,5 @@ killall() {
 # Start all the dev servers in async.
 source "$VIRTUAL_ENV/bin/activate"
 python manage.py runserver_plus $HOST:$PORT &
-celery -A misirlou  worker -l info
+# -B runs celery beat in the worker, for the periodic tasks.
+celery -A misirlou  worker -B -l info